@@ -1,43 +1,83 @@
-import fitz
+import argparse
+import os
+import re
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import pandas as pd
-
-def get_uid_and_nip(file:Path):
-    doc = fitz.open(file)
-    text = ""
-    for page in doc:
-        text+=page.get_text()
-    pieces = text.split()
-    for piece in pieces:
-        try:
-            uid = uuid.UUID(piece)
-        except ValueError:
-            uid=None
-        else:
-            break
-    for piece in pieces:
-        nip = piece
-        if nip.isdigit() and len(nip) == 6:
-            break
-        else:
-            nip = None
+
+import fitz
+
+from registration.cardgenerator.cardgenerator import parse_card_keywords
+from registration.cardgenerator.cardindex import CardIndex, default_card_index, file_hash
+from registration.registry import StudentRegistry
+
+UUID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', re.IGNORECASE)
+NIP_PATTERN = re.compile(r'(?<!\S)\d{6}(?!\S)')
+
+
+def _result(nip, uid) -> dict:
     try:
-        ret = {int(nip):uid}
-    except:
-        ret = {None:uid}
-    return ret
+        return {int(nip): uid}
+    except (TypeError, ValueError):
+        return {None: uid}
+
+
+def uid_and_nip_from_metadata(file:Path) -> dict | None:
+    """Reads the uuid and NIP the generator stored in the PDF keywords (None for older cards)."""
+    with fitz.open(file) as doc:
+        found = parse_card_keywords(doc.metadata.get('keywords'))
+    if found is None:
+        return None
+    return _result(found['nip'], uuid.UUID(found['uuid']))
+
+
+def get_uid_and_nip(file:Path) -> dict:
+    """Finds the uuid and NIP printed on the first page of a card."""
+    with fitz.open(file) as doc:
+        text = doc[0].get_text() if len(doc) else ''
+    uid = UUID_PATTERN.search(text)
+    nip = NIP_PATTERN.search(text)
+    return _result(nip and nip.group(), uid and uuid.UUID(uid.group()))
+
+
+def recover_uuids(files:list[Path], workers:int | None = None, index:CardIndex | None = None) -> dict:
+    """
+    NIP -> uuid for every card in files. Cards in the card index (and unchanged
+    since) are taken from it, cards with metadata are read in this process, and
+    only the older ones have their text extracted, in a process pool.
+    """
+    index = index if index is not None else default_card_index()
+    found, fallback = {}, []
+    for file in files:
+        card = index.card_at(file)
+        if card is not None and card['uuid'] and card['sha1'] == file_hash(file):
+            found[card['nip']] = uuid.UUID(card['uuid'])
+            continue
+        data = uid_and_nip_from_metadata(file)
+        if data is None:
+            fallback.append(file)
+        else:
+            found.update(data)
+    print(len(files) - len(fallback), 'cards read from the index or metadata,', len(fallback), 'from their text')
+    if fallback:
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(workers) as pool:
+            chunksize = max(1, len(fallback) // (workers * 4))
+            for file, data in zip(fallback, pool.map(get_uid_and_nip, fallback, chunksize=chunksize)):
+                print(file.name, ' --> ', data)
+                found.update(data)
+    return found
+
 
 if __name__ == '__main__':
-    base_path = Path('F:\TarjetasPlazoleta\codebase\output_cards')
-    data_list = {}
-    for file in base_path.glob('*.pdf'):
-        data = get_uid_and_nip(file)
-        print(file.name, ' --> ', data)
-        data_list = data_list | data
-    database = 'database.xlsx'
-    db = pd.read_excel(database)
-    db['uuid'] = db['NIP Unizar'].map(data_list).fillna(db['uuid'])
-    print(db['NIP Unizar'].map(data_list).fillna(db['uuid']))
-    db.to_excel(database, index=False)
-    
+    parser = argparse.ArgumentParser(description='Recover the uuid of each student from their generated cards')
+    parser.add_argument('folder', type=Path, nargs='?', default=Path('output_cards'))
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+    data_list = recover_uuids(sorted(args.folder.glob('*.pdf')), args.workers)
+    registry = StudentRegistry()
+    db = registry.to_dataframe()
+    found = {nip: str(uid) for nip, uid in data_list.items() if uid is not None}
+    db['uuid'] = db['NIP Unizar'].map(found).fillna(db['uuid'])
+    print(db[['NIP Unizar', 'uuid']])
+    registry.upsert(db[['NIP Unizar', 'uuid']])
@@ -15,9 +15,11 @@ from smartcard.CardConnection import CardConnection
 import pandas as pd
 from typing import Dict, Any, List
 import datetime
+from registration.excelcache import read_excel_cached, to_excel_cached
+from registration.registry import REGISTRY_FILE, StudentRegistry
 
 # --- Ingress Logic from PostgreSQL Function ---
-def ingress_logic(uuid: str, action: int, df_ingress: pd.DataFrame, df_student_data: pd.DataFrame) -> Dict[str, Any]:
+def ingress_logic(uuid: str, action: int, df_ingress: pd.DataFrame, students: StudentRegistry) -> Dict[str, Any]:
     """
     Translates the PostgreSQL ingress function logic into Python.
 
@@ -25,14 +27,13 @@ def ingress_logic(uuid: str, action: int, df_ingress: pd.DataFrame, df_student_d
         uuid (str): The unique ID of the card.
         action (int): 1 for entry, 0 for exit.
         df_ingress (pd.DataFrame): DataFrame loaded from INGRESS.xlsx.
-        df_student_data (pd.DataFrame): DataFrame loaded from database.xlsx.
+        students (StudentRegistry): The student registry.
 
     Returns:
         Dict[str, Any]: A dictionary with the result of the access control check.
     """
     # Fetch student data for display regardless of access result
-    student_data = df_student_data[df_student_data['uuid'] == uuid]
-    student_data_dict = student_data.iloc[0].to_dict() if not student_data.empty else None
+    student_data_dict = students.get_by_uuid(uuid) if uuid else None
 
     # Rule 0: Check input and if user exists
     if not uuid or action is None:
@@ -65,7 +66,7 @@ def ingress_logic(uuid: str, action: int, df_ingress: pd.DataFrame, df_student_d
     df_ingress.loc[ingress_user_data.index, 'last_change'] = datetime.datetime.now()
     
     # Save the updated DataFrame back to the Excel file
-    df_ingress.to_excel('INGRESS.xlsx', index=False)
+    to_excel_cached(df_ingress, 'INGRESS.xlsx')
 
     return {'result': 'OK', 'message': 'OK', 'student_data': student_data_dict}
 
@@ -152,12 +153,12 @@ class AccessControlWidget(ttk.Frame):
         Args:
             parent (tk.Widget): The parent widget to embed this frame into.
             ingress_file (str): The path to the INGRESS.xlsx file.
-            student_data_file (str): The path to the database.xlsx file.
+            student_data_file (str): The path to the student registry.
         """
         super().__init__(parent)
         self.ingress_file = ingress_file
         self.student_data_file = student_data_file
-        self.df_student_data = self.load_data(self.student_data_file)
+        self.registry = StudentRegistry(student_data_file)
         self.df_ingress = self.load_data(self.ingress_file)
         
         # State variables
@@ -173,10 +174,11 @@ class AccessControlWidget(ttk.Frame):
         
     def load_data(self, file_path):
         """
-        Loads data from an Excel file. If INGRESS.xlsx is not found, it creates it.
+        Loads data from an Excel file (through its Parquet snapshot). If INGRESS.xlsx
+        is not found, it creates it.
         """
         try:
-            df = pd.read_excel(file_path)
+            df = read_excel_cached(file_path)
             # Ensure required columns for INGRESS.xlsx exist
             if 'INGRESS' in file_path and ('uuid' not in df.columns or 'status' not in df.columns or 'last_change' not in df.columns):
                  raise ValueError("Required columns 'uuid', 'status', 'last_change' not found in INGRESS.xlsx.")
@@ -188,34 +190,20 @@ class AccessControlWidget(ttk.Frame):
             print(f"Error: The file '{file_path}' was not found.")
             if 'INGRESS' in file_path:
                 print("INGRESS.xlsx not found. Creating a new one...")
-                try:
-                    df_db = pd.read_excel(self.student_data_file)
-                    if 'uuid' not in df_db.columns:
-                        print("Error: 'uuid' column not found in database.xlsx. Cannot generate INGRESS.xlsx.")
-                        return pd.DataFrame({'uuid': [], 'status': [], 'last_change': []})
-
-                    uuids = df_db['uuid'].tolist()
-                    num_uuids = len(uuids)
-                    
-                    initial_data = {
-                        'uuid': uuids,
-                        'status': [0] * num_uuids,
-                        'last_change': [datetime.datetime.now() - datetime.timedelta(hours=1)] * num_uuids
-                    }
-                    
-                    df_ingress_new = pd.DataFrame(initial_data)
-                    df_ingress_new.to_excel(file_path, index=False)
-                    print(f"Successfully generated new INGRESS.xlsx at {file_path}")
-                    return df_ingress_new
-                except FileNotFoundError:
-                    print(f"Error: The required file '{self.student_data_file}' was not found. Cannot generate INGRESS.xlsx.")
-                    return pd.DataFrame({'uuid': [], 'status': [], 'last_change': []})
-            else:
-                # Create a dummy database.xlsx if not found
-                print("Creating a dummy database.xlsx file.")
-                dummy_df = pd.DataFrame({'NIP Unizar': [], 'uuid': [], 'Nombre': [], 'Apellidos': [], 'Estudios Matriculados': [], 'Fotografia': []})
-                dummy_df.to_excel(file_path, index=False)
-                return dummy_df
+                uuids = self.registry.to_dataframe('uuid IS NOT NULL')['uuid'].tolist()
+                num_uuids = len(uuids)
+
+                initial_data = {
+                    'uuid': uuids,
+                    'status': [0] * num_uuids,
+                    'last_change': [datetime.datetime.now() - datetime.timedelta(hours=1)] * num_uuids
+                }
+
+                df_ingress_new = pd.DataFrame(initial_data)
+                to_excel_cached(df_ingress_new, file_path)
+                print(f"Successfully generated new INGRESS.xlsx at {file_path}")
+                return df_ingress_new
+            return pd.DataFrame()
             
     def create_widgets(self):
         # Mode selection
@@ -240,7 +228,7 @@ class AccessControlWidget(ttk.Frame):
     def on_card_read(self, uuid: str):
         """Callback to handle a successful card read."""
         action = 1 if self.mode.get() == 'entry' else 0
-        response = ingress_logic(uuid, action, self.df_ingress, self.df_student_data)
+        response = ingress_logic(uuid, action, self.df_ingress, self.registry)
         
         result = response['result']
         message = response['message']
@@ -334,9 +322,9 @@ class NTAG215Observer(CardObserver):
                 self.app.status_label.config(foreground="red")
 
 if __name__ == "__main__":
-    # Create mock database.xlsx for testing if it doesn't exist
-    if not os.path.exists('database.xlsx'):
-        print("Creating mock database.xlsx for demonstration...")
+    # Fill a mock registry for testing if it doesn't exist
+    if not os.path.exists(REGISTRY_FILE):
+        print("Creating mock registry for demonstration...")
         mock_data_students = {
             'NIP Unizar': [123456, 789012],
             'uuid': ['76d452ab-89ca-4d0a-a2d1-2ffa9ab61117', 'another-uuid-for-testing'],
@@ -346,14 +334,14 @@ if __name__ == "__main__":
             'Fotografia': ['path/to/photo1.jpg', 'path/to/photo2.jpg']
         }
         df_students = pd.DataFrame(mock_data_students)
-        df_students.to_excel('database.xlsx', index=False)
+        StudentRegistry(REGISTRY_FILE).upsert(df_students)
 
     # Example of how to use the AccessControlWidget
     root = tk.Tk()
     root.title("My Main Tkinter Application")
 
     # Create an instance of the widget and pack it into the main window
-    access_widget = AccessControlWidget(root, 'INGRESS.xlsx', 'database.xlsx')
+    access_widget = AccessControlWidget(root, 'INGRESS.xlsx', str(REGISTRY_FILE))
     access_widget.pack(fill='both', expand=True, padx=20, pady=20)
     
     # Define a function to properly close the app and the monitor
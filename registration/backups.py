@@ -0,0 +1,169 @@
+"""
+Incremental backups of the student registry.
+
+Instead of a full copy per watcher run, each snapshot stores only the rows
+added, changed or deleted (keyed by NIP) since the previous one, as
+lz4-compressed JSON. Every CHECKPOINT_EVERY deltas a full checkpoint is written
+so a restore never replays a long chain. The manifest keeps a hash per row of
+the last snapshot, which is what the next delta is computed against.
+
+    python -m registration.backups list
+    python -m registration.backups restore --at "2026-10-01 12:00" --output restored.sqlite
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+import lz4.frame
+import pandas as pd
+
+from registration.registry import KEY, StudentRegistry
+
+BACKUP_FOLDER = Path("backups")
+CHECKPOINT_EVERY = 50  # deltas between full checkpoints
+RETENTION_DAYS = 30
+KEEP_CHECKPOINTS = 3  # kept even when older than RETENTION_DAYS
+
+
+def _records(df:pd.DataFrame) -> dict[str, dict]:
+    df = df.astype(object).where(df.notna(), None)
+    return {str(row[KEY]): row for row in df.to_dict('records')}
+
+
+def _row_hash(row:dict) -> str:
+    return hashlib.sha1(json.dumps(row, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _write(path:Path, payload:dict):
+    tmp = path.with_name(path.name + '.part')
+    tmp.write_bytes(lz4.frame.compress(json.dumps(payload, default=str).encode()))
+    os.replace(tmp, path)
+
+
+def _read(path:Path) -> dict:
+    return json.loads(lz4.frame.decompress(path.read_bytes()))
+
+
+class BackupStore:
+    def __init__(self, folder:Path = BACKUP_FOLDER, checkpoint_every:int = CHECKPOINT_EVERY,
+                 retention_days:float = RETENTION_DAYS, keep_checkpoints:int = KEEP_CHECKPOINTS):
+        self.folder = Path(folder)
+        self.manifest_file = self.folder / 'manifest.json'
+        self.checkpoint_every = checkpoint_every
+        self.retention_days = retention_days
+        self.keep_checkpoints = keep_checkpoints
+        if self.manifest_file.exists():
+            self.manifest = json.loads(self.manifest_file.read_text())
+        else:
+            self.manifest = {'snapshots': [], 'head': {}}
+
+    def _save_manifest(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        tmp = self.manifest_file.with_suffix('.json.part')
+        tmp.write_text(json.dumps(self.manifest))
+        os.replace(tmp, self.manifest_file)
+
+    def snapshot(self, df:pd.DataFrame, now:float | None = None) -> dict | None:
+        """
+        Records the registry's rows. Writes a delta against the previous
+        snapshot (or a checkpoint when one is due) and returns its manifest
+        entry, or None if nothing changed.
+        """
+        now = time.time() if now is None else now
+        rows = _records(df)
+        hashes = {nip: _row_hash(row) for nip, row in rows.items()}
+        head = self.manifest['head']
+        upserts = [nip for nip, h in hashes.items() if head.get(nip) != h]
+        deletes = [nip for nip in head if nip not in hashes]
+        snapshots = self.manifest['snapshots']
+        if snapshots and not upserts and not deletes:
+            return None
+
+        since_checkpoint = next(
+            (i for i, s in enumerate(reversed(snapshots)) if s['kind'] == 'checkpoint'), None)
+        kind = 'checkpoint' if since_checkpoint is None or since_checkpoint + 1 >= self.checkpoint_every else 'delta'
+        seq = snapshots[-1]['seq'] + 1 if snapshots else 0
+        name = f'{seq:06d}-{datetime.fromtimestamp(now).strftime("%Y%m%d%H%M%S")}.{kind}.json.lz4'
+        self.folder.mkdir(parents=True, exist_ok=True)
+        if kind == 'checkpoint':
+            _write(self.folder / name, {'rows': list(rows.values())})
+        else:
+            _write(self.folder / name, {'upserts': [rows[nip] for nip in upserts], 'deletes': deletes})
+        entry = {
+            'seq': seq, 'kind': kind, 'time': now, 'file': name,
+            'added': sum(nip not in head for nip in upserts),
+            'changed': sum(nip in head for nip in upserts),
+            'deleted': len(deletes),
+        }
+        snapshots.append(entry)
+        self.manifest['head'] = hashes
+        self.prune(now)
+        self._save_manifest()
+        return entry
+
+    def prune(self, now:float | None = None):
+        """Drops snapshots older than the retention period that no kept checkpoint needs."""
+        now = time.time() if now is None else now
+        snapshots = self.manifest['snapshots']
+        checkpoints = [i for i, s in enumerate(snapshots) if s['kind'] == 'checkpoint']
+        cutoff = now - self.retention_days * 24 * 60 * 60
+        # The oldest checkpoint still needed: newest one at or before the cutoff,
+        # but never fewer than keep_checkpoints checkpoints
+        keep_from = 0
+        for i in checkpoints:
+            if snapshots[i]['time'] <= cutoff:
+                keep_from = i
+        if checkpoints:
+            keep_from = min(keep_from, checkpoints[max(0, len(checkpoints) - self.keep_checkpoints)])
+        for entry in snapshots[:keep_from]:
+            (self.folder / entry['file']).unlink(missing_ok=True)
+        self.manifest['snapshots'] = snapshots[keep_from:]
+
+    def restore(self, at:datetime | float | None = None) -> pd.DataFrame:
+        """The registry's rows as of the last snapshot taken at or before at (default: latest)."""
+        if isinstance(at, datetime):
+            at = at.timestamp()
+        snapshots = [s for s in self.manifest['snapshots'] if at is None or s['time'] <= at]
+        start = next((i for i in range(len(snapshots) - 1, -1, -1) if snapshots[i]['kind'] == 'checkpoint'), None)
+        if start is None:
+            raise ValueError(f'No backup checkpoint at or before {at}')
+        rows = {}
+        for entry in snapshots[start:]:
+            payload = _read(self.folder / entry['file'])
+            if entry['kind'] == 'checkpoint':
+                rows = {str(row[KEY]): row for row in payload['rows']}
+                continue
+            for row in payload['upserts']:
+                rows[str(row[KEY])] = row
+            for nip in payload['deletes']:
+                rows.pop(nip, None)
+        return pd.DataFrame(list(rows.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['list', 'snapshot', 'restore'])
+    parser.add_argument('--folder', type=Path, default=BACKUP_FOLDER)
+    parser.add_argument('--at', type=datetime.fromisoformat, help='Restore the state as of this date/time')
+    parser.add_argument('--output', type=Path, default=Path('restored.sqlite'),
+                        help='Registry (.sqlite) or workbook (.xlsx) to restore into')
+    args = parser.parse_args()
+
+    store = BackupStore(args.folder)
+    if args.command == 'list':
+        for s in store.manifest['snapshots']:
+            print(s['seq'], datetime.fromtimestamp(s['time']).isoformat(' ', 'seconds'), s['kind'],
+                  f"+{s['added']} ~{s['changed']} -{s['deleted']}")
+    elif args.command == 'snapshot':
+        print(store.snapshot(StudentRegistry().to_dataframe()) or 'No changes since the last snapshot.')
+    else:
+        df = store.restore(args.at)
+        if args.output.suffix == '.xlsx':
+            df.to_excel(args.output, index=False)
+        else:
+            StudentRegistry(args.output, legacy_excel=None).upsert(df)
+        print(len(df), 'students restored to', args.output)
@@ -0,0 +1,157 @@
+"""
+Card generation benchmark.
+
+Builds synthetic students and photos, then times single, batch and parallel
+generate_card runs for every CardOptions background. Results are written as
+JSON and, when a baseline exists, compared against it:
+
+    python -m registration.cardgenerator.benchmark --save
+    python -m registration.cardgenerator.benchmark --baseline card_benchmark.json
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import get_args, get_type_hints
+from uuid import uuid4
+
+from PIL import Image
+
+from registration.cardgenerator import photocache
+from registration.cardgenerator.cardgenerator import CardOptions, generate_card
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BACKGROUND_OPTIONS = get_args(get_type_hints(CardOptions)['background'])
+NAMES = ['Laia', 'Pablo', 'María José', 'Iñigo', 'Lucía', 'Javier', 'Ana Belén']
+SURNAMES = ['García López', 'Martínez Ruiz', 'Fernández de la Torre', 'Pérez Gil']
+STUDIES = ['Grado en Veterinaria', 'Grado en Ciencia y Tecnología de los Alimentos', 'PDI / PAS']
+
+
+def synthetic_students(count:int, photo_dir:Path, seed:int = 0) -> list[dict]:
+    """Creates `count` fake students, each with a 413x531 PNG like images/croped."""
+    rng = random.Random(seed)
+    photo_dir.mkdir(parents=True, exist_ok=True)
+    students = []
+    for i in range(count):
+        photo = photo_dir / f'{i}.png'
+        if not photo.exists():
+            noise = Image.effect_noise((413, 531), rng.randint(20, 80)).convert('RGB')
+            noise.save(photo)
+        students.append({
+            'profile_picture': photo,
+            'serial_number': uuid4(),
+            'name': rng.choice(NAMES),
+            'surname': rng.choice(SURNAMES),
+            'nip': str(rng.randint(100000, 999999)),
+            'department': rng.choice(STUDIES),
+        })
+    return students
+
+
+def peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux; children covers the process pool
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def _generate(job:tuple[dict, Path, str]) -> tuple[dict, int]:
+    student, output_file, background = job
+    timings = {}
+    generate_card(str(output_file), cardoptions=CardOptions(background), timings=timings, **student)  # pyright: ignore[reportArgumentType]
+    return timings, output_file.stat().st_size
+
+
+def _summarise(results:list[tuple[dict, int]], elapsed:float) -> dict:
+    phases = {}
+    for timings, _ in results:
+        for phase, seconds in timings.items():
+            phases[phase] = phases.get(phase, 0.0) + seconds
+    count = len(results)
+    return {
+        'cards': count,
+        'seconds': elapsed,
+        'cards_per_second': count / elapsed if elapsed else None,
+        'phase_ms_per_card': {k: 1000 * v / count for k, v in phases.items()},
+        'mean_pdf_bytes': sum(size for _, size in results) / count,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_scenario(students:list[dict], background:str, output_dir:Path, workers:int = 1) -> dict:
+    jobs = [
+        (student, output_dir / f'{background}_{i}.pdf', background)
+        for i, student in enumerate(students)
+    ]
+    start = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(_generate, jobs))
+    else:
+        results = [_generate(job) for job in jobs]
+    return _summarise(results, time.perf_counter() - start)
+
+
+def run_benchmark(batch_size:int = 50, workers:int | None = None, workdir:Path | None = None) -> dict:
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(workdir or tmp)
+        # Keep synthetic photos out of the real photo cache, also in workers
+        photocache.CACHE_DIR = workdir / 'photo_cache'
+        os.environ['ESMERALDA_PHOTO_CACHE'] = str(photocache.CACHE_DIR)
+        students = synthetic_students(batch_size, workdir / 'photos')
+        output_dir = workdir / 'cards'
+        output_dir.mkdir(parents=True, exist_ok=True)
+        results = {}
+        for background in BACKGROUND_OPTIONS:
+            # The first single card also pays for font registration and caches
+            results[f'{background}/single'] = run_scenario(students[:1], background, output_dir)
+            results[f'{background}/batch'] = run_scenario(students, background, output_dir)
+            results[f'{background}/parallel{workers}'] = run_scenario(students, background, output_dir, workers)
+            print(background, 'done')
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'batch_size': batch_size,
+        'workers': workers,
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+
+
+def compare(current:dict, baseline:dict):
+    print(f"{'scenario':<28}{'cards/s':>10}{'baseline':>10}{'change':>9}")
+    for name, result in current['results'].items():
+        now = result['cards_per_second']
+        before = baseline['results'].get(name, {}).get('cards_per_second')
+        if before:
+            print(f'{name:<28}{now:>10.1f}{before:>10.1f}{(now / before - 1):>+9.1%}')
+        else:
+            print(f"{name:<28}{now:>10.1f}{'-':>10}{'':>9}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--baseline', type=Path, default=Path('card_benchmark.json'))
+    parser.add_argument('--save', action='store_true', help='Overwrite the baseline with this run')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.batch_size, args.workers)
+    if args.baseline.exists():
+        compare(report, json.loads(args.baseline.read_text()))
+    else:
+        compare(report, {'results': {}})
+    if args.save or not args.baseline.exists():
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print('Baseline written to', args.baseline)
@@ -6,56 +6,105 @@ from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.styles import (ParagraphStyle, getSampleStyleSheet)
 from reportlab.platypus import Paragraph
 from uuid import UUID
-from typing import Literal
+from typing import TYPE_CHECKING, Literal
 from dataclasses import dataclass
+from functools import lru_cache
 import os
+import time
+
+from registration.cardgenerator.photocache import cached_photo
+
+if TYPE_CHECKING:
+    from registration.cardgenerator.cardindex import CardIndex
 
 @dataclass
 class CardOptions:
     background: Literal['emerald', 'silver', 'ruby', 'gold'] = "emerald"
 
+# Background file and frame stroke colour (CMYK) for each CardOptions.background
+BACKGROUNDS = {
+    'emerald': 'emerald_card.jpg',
+    'silver': 'silver_card.jpg',
+    'ruby': 'ruby_card.jpg',
+    'gold': 'gold_card.jpg',
+}
+STROKE_COLORS = {
+    'emerald': (0.8, 0.0, 0.45, 0.2),
+    'silver': (0.2, 0.15, 0.15, 0.4),
+    'ruby': (0., .9, 0.9, 0.3),
+    'gold': (0.2, 0.3, 0.85, 0.15),
+}
+
 def register_font(ttf_file:Path):
     font_name= ttf_file.name.removesuffix(ttf_file.suffix)
     pdfmetrics.registerFont(TTFont(font_name, ttf_file))
 
-if os.name == 'nt':  # Windows
-    RESOURCES = Path(r'F:\TarjetasPlazoleta\Esmeralda\registration\cardgenerator\resources')
-elif os.name == 'posix': # Linux
-    RESOURCES = Path(r'/run/media/steve/Data/TarjetasPlazoleta/Esmeralda/registration/cardgenerator/resources')
-else:
-    RESOURCES = Path(__file__).parent / 'resources'
+# Package-relative by default; set ESMERALDA_RESOURCES to use another folder
+RESOURCES = Path(os.environ.get('ESMERALDA_RESOURCES', Path(__file__).parent / 'resources'))
+
+FONTS = {
+    'RobotoMono-Medium': RESOURCES / 'Roboto_Mono' / 'static' / 'RobotoMono-Medium.ttf',
+    'Inter-ExtraBold': RESOURCES / 'Inter' / 'extras' / 'ttf' / 'Inter-ExtraBold.ttf',
+    'Inter-ExtraLight': RESOURCES / 'Inter' / 'extras' / 'ttf' / 'Inter-ExtraLight.ttf',
+    }
+
+@lru_cache(maxsize=None)
+def register_fonts():
+    """
+    Registers the card fonts with reportlab the first time a card is rendered.
+
+    Parsing the TTF files is the expensive part of importing this module, so it
+    is deferred until something actually draws a card.
+    """
+    for font in FONTS.values():
+        register_font(font)
+
+# Bump when the card layout changes, so cards printed with the old one can be found
+TEMPLATE_VERSION = 1
+
+# Written to every card's PDF keywords so tools can tell whose card a file is
+# without parsing the page text
+CARD_KEYWORDS = 'esmeralda-card uuid={uuid} nip={nip}'
+
+def card_keywords(serial_number:UUID, nip:str) -> str:
+    return CARD_KEYWORDS.format(uuid=str(serial_number).lower(), nip=nip)
+
+def parse_card_keywords(keywords:str | None) -> dict | None:
+    """{'uuid': ..., 'nip': ...} from a card's PDF keywords, or None if they aren't ours."""
+    fields = dict(part.split('=', 1) for part in (keywords or '').split() if '=' in part)
+    if not (keywords or '').startswith('esmeralda-card') or 'uuid' not in fields:
+        return None
+    return {'uuid': fields['uuid'], 'nip': fields.get('nip')}
 
-FONTS = [ 
-    RESOURCES / 'Roboto_Mono' / 'static' / 'RobotoMono-Medium.ttf',
-    RESOURCES / 'Inter' / 'extras' / 'ttf' / 'Inter-ExtraBold.ttf',
-    RESOURCES / 'Inter' / 'extras' / 'ttf' / 'Inter-ExtraLight.ttf',
-    ]
-for font in FONTS:
-    register_font(font)
+def _lap(timings:dict | None, phase:str, start:float) -> float:
+    now = time.perf_counter()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + now - start
+    return now
 
 
 def generate_card(
     output_file:Path, profile_picture:Path, serial_number:UUID, 
     name:str, surname:str, nip:str, department:str,
-    cardoptions:CardOptions
+    cardoptions:CardOptions, timings:dict | None = None, card_index:'CardIndex | None' = None
     ):
+    # timings, when given, is filled with seconds spent per phase
+    # ('fonts', 'images', 'text', 'save') for benchmarking. When card_index
+    # is given, the card is recorded in it.
 
+    start = time.perf_counter()
+    register_fonts()
+    start = _lap(timings, 'fonts', start)
     canvas = canv.Canvas(
         output_file, 
         pagesize=(85*mm,54*mm)
         )
+    canvas.setTitle(f'{name} {surname}')
+    canvas.setSubject(nip)
+    canvas.setKeywords(card_keywords(serial_number, nip))
 
     # Background image 
-    match cardoptions.background:
-        case 'emerald':
-            background_image = RESOURCES / 'emerald_card.jpg'
-        case 'silver':
-            background_image = RESOURCES / 'silver_card.jpg'
-        case 'ruby':
-            background_image = RESOURCES / 'ruby_card.jpg'
-        case 'gold':
-            background_image = RESOURCES / 'gold_card.jpg'
-        
+    background_image = RESOURCES / BACKGROUNDS[cardoptions.background]
     canvas.drawImage(
         background_image,
         0,0, 
@@ -78,15 +127,7 @@ def generate_card(
     logo_width = 36.8
     logo_ratio= 443 / float(1631)
     frame = RESOURCES / 'frame.png'
-    match cardoptions.background:
-        case 'emerald':
-            canvas.setStrokeColorCMYK(0.8,0.0,0.45,0.2)
-        case 'silver':
-            canvas.setStrokeColorCMYK(0.2,0.15,0.15,0.4)
-        case 'ruby':
-            canvas.setStrokeColorCMYK(0.,.9,0.9,0.3)
-        case 'gold':
-            canvas.setStrokeColorCMYK(0.2,0.3,0.85,0.15)
+    canvas.setStrokeColorCMYK(*STROKE_COLORS[cardoptions.background])
     
     # draw some lines
     canvas.line(49.1*mm,11*mm,74*mm,11*mm)
@@ -94,11 +135,12 @@ def generate_card(
     canvas.line(49.1*mm,11*mm,49.1*mm,43*mm)
     canvas.line(74*mm,11*mm,74*mm,43*mm)
     canvas.drawImage(
-        profile_picture ,
+        str(cached_photo(profile_picture)),
         49.6*mm,11.5*mm, 
         width=23.9*mm, 
         height=31*mm,
         )
+    start = _lap(timings, 'images', start)
 
     # Serial Number
     canvas.setFont('RobotoMono-Medium', 6)
@@ -123,8 +165,12 @@ def generate_card(
     P2=Paragraph(department,p2_style)
     P2.wrap(38*mm, 7*mm)
     P2.drawOn(canvas,8*mm,12*mm)
+    start = _lap(timings, 'text', start)
 
     canvas.showPage()
     canvas.save()
+    if card_index is not None and str(nip).isdigit():
+        card_index.record(output_file, nip, serial_number, TEMPLATE_VERSION, cardoptions.background)
+    _lap(timings, 'save', start)
 
     return output_file
\ No newline at end of file
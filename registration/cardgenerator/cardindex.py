@@ -0,0 +1,154 @@
+"""
+Index of generated cards: which file holds each student's card, the uuid and
+template it was built with, and the file's hash.
+
+It lives in a 'cards' table next to the students in the registry database, so
+'cards for uuid X', 'cards built with an old template' and 'students without a
+card' are indexed queries instead of globbing output_cards and parsing PDFs.
+generate_card records the cards it writes when given an index. The first time
+an empty index is opened through default_card_index, the cards already in
+output_cards are indexed.
+
+    python -m registration.cardgenerator.cardindex rebuild output_cards
+    python -m registration.cardgenerator.cardindex outdated
+"""
+import argparse
+import hashlib
+import sqlite3
+import time
+from functools import lru_cache
+from pathlib import Path
+
+from registration.registry import KEY, REGISTRY_FILE
+
+CARD_FOLDER = Path("output_cards")
+TEMPLATE_FILE = CARD_FOLDER / "template.pdf"
+
+
+def file_hash(path:Path) -> str:
+    return hashlib.sha1(Path(path).read_bytes()).hexdigest()
+
+
+class CardIndex:
+    def __init__(self, path:Path = REGISTRY_FILE):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS cards (path TEXT PRIMARY KEY, nip INTEGER, uuid TEXT, '
+            'sha1 TEXT, template INTEGER, background TEXT, built REAL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cards_nip ON cards (nip)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cards_uuid ON cards (uuid)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cards_template ON cards (template)')
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM cards').fetchone()[0]
+
+    def _rows(self, sql:str, params=()) -> list[dict]:
+        cursor = self.conn.execute(sql, params)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def record(self, path:Path, nip, uuid, template:int, background:str | None = None):
+        """Adds or replaces the entry for the card written at path."""
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (Path(path).as_posix(), int(nip), str(uuid).lower(), file_hash(path),
+                 template, background, time.time()),
+            )
+
+    def forget(self, path:Path):
+        with self.conn:
+            self.conn.execute('DELETE FROM cards WHERE path = ?', (Path(path).as_posix(),))
+
+    def card_at(self, path:Path) -> dict | None:
+        cards = self._rows('SELECT * FROM cards WHERE path = ?', (Path(path).as_posix(),))
+        return cards[0] if cards else None
+
+    def card_for(self, nip) -> dict | None:
+        """The latest card built for a NIP, or None if it has none."""
+        cards = self._rows('SELECT * FROM cards WHERE nip = ? ORDER BY built DESC LIMIT 1', (int(nip),))
+        return cards[0] if cards else None
+
+    def card_file(self, nip, folder:Path = CARD_FOLDER) -> Path | None:
+        """
+        The NIP's card on disk: the latest indexed one if its file still
+        exists, otherwise '<nip>.pdf' in folder as cards were found before the
+        index. None if neither exists.
+        """
+        card = self.card_for(nip)
+        if card is not None and Path(card['path']).exists():
+            return Path(card['path'])
+        legacy = Path(folder) / f'{int(nip)}.pdf'
+        return legacy if legacy.exists() else None
+
+    def cards_for_uuid(self, uuid) -> list[dict]:
+        return self._rows('SELECT * FROM cards WHERE uuid = ?', (str(uuid).lower(),))
+
+    def outdated(self, template:int) -> list[dict]:
+        """Cards built with a template older than template."""
+        return self._rows('SELECT * FROM cards WHERE template IS NULL OR template < ? ORDER BY nip', (template,))
+
+    def students_without_card(self) -> list[int]:
+        """NIPs in the registry with no card in the index."""
+        if not self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'students'").fetchone():
+            return []
+        return [row[0] for row in self.conn.execute(
+            f'SELECT "{KEY}" FROM students WHERE "{KEY}" NOT IN (SELECT nip FROM cards WHERE nip IS NOT NULL) '
+            f'ORDER BY "{KEY}"'
+        )]
+
+    def rebuild(self, folder:Path = CARD_FOLDER) -> int:
+        """
+        Indexes the PDFs already in folder (cards generated before the index
+        existed). Uses the metadata generate_card embeds; cards without it are
+        recorded under their '<nip>.pdf' file name with no uuid or template.
+        """
+        import fitz
+
+        from registration.cardgenerator.cardgenerator import parse_card_keywords
+
+        count = 0
+        for pdf in sorted(Path(folder).glob('*.pdf')):
+            with fitz.open(pdf) as doc:
+                found = parse_card_keywords(doc.metadata.get('keywords')) or {}
+            nip = found.get('nip') or pdf.stem
+            if not str(nip).isdigit():
+                continue
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (pdf.as_posix(), int(nip), found.get('uuid'), file_hash(pdf), None, None, pdf.stat().st_mtime),
+                )
+            count += 1
+        return count
+
+
+@lru_cache(maxsize=None)
+def default_card_index() -> CardIndex:
+    index = CardIndex()
+    if not len(index) and CARD_FOLDER.exists():
+        # First use on an install whose cards predate the index
+        print(index.rebuild(CARD_FOLDER), 'cards in', CARD_FOLDER, 'indexed')
+    return index
+
+
+if __name__ == '__main__':
+    from registration.cardgenerator.cardgenerator import TEMPLATE_VERSION
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['rebuild', 'outdated', 'missing'])
+    parser.add_argument('folder', type=Path, nargs='?', default=CARD_FOLDER)
+    args = parser.parse_args()
+
+    index = default_card_index()
+    if args.command == 'rebuild':
+        print(index.rebuild(args.folder), 'cards indexed')
+    elif args.command == 'outdated':
+        for card in index.outdated(TEMPLATE_VERSION):
+            print(card['nip'], card['path'], 'template', card['template'])
+    else:
+        for nip in index.students_without_card():
+            print(nip)
@@ -0,0 +1,44 @@
+import hashlib
+import os
+from functools import lru_cache
+from pathlib import Path
+
+from PIL import Image
+
+# Printed size of the profile picture on the card, in millimetres
+PHOTO_SIZE_MM = (23.9, 31)
+PHOTO_DPI = 300
+JPEG_QUALITY = 90
+CACHE_DIR = Path(os.environ.get('ESMERALDA_PHOTO_CACHE', 'images/card_photos'))
+
+
+def photo_hash(photo:Path) -> str:
+    return hashlib.sha1(Path(photo).read_bytes()).hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def _cached_photo(photo:str, mtime_ns:int, size:int, dpi:int) -> Path:
+    # mtime and size are only part of the key so an edited photo is re-hashed
+    output = CACHE_DIR / f'{photo_hash(photo)}_{dpi}.jpg'
+    if not output.exists():
+        width = round(PHOTO_SIZE_MM[0] * dpi / 25.4)
+        height = round(PHOTO_SIZE_MM[1] * dpi / 25.4)
+        img = Image.open(photo).convert('RGB').resize((width, height), Image.Resampling.LANCZOS)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        tmp = output.with_suffix('.part')
+        img.save(tmp, 'JPEG', quality=JPEG_QUALITY, dpi=(dpi, dpi))
+        os.replace(tmp, output)
+    return output
+
+
+def cached_photo(photo:Path, dpi:int = PHOTO_DPI) -> Path:
+    """
+    Returns the card-ready version of a profile picture.
+
+    The photo is scaled to its printed size at `dpi` and stored as a baseline
+    JPEG named after the hash of the source file. reportlab embeds JPEG data
+    as-is, so cards built from the cached file skip the PNG decode and Flate
+    re-encode that drawImage otherwise does for every card.
+    """
+    stat = os.stat(photo)
+    return _cached_photo(str(photo), stat.st_mtime_ns, stat.st_size, dpi)
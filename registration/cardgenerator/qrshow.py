@@ -1,6 +1,154 @@
+"""
+QR codes of the students' uuids: an interactive viewer and printable contact
+sheets.
+
+    python -m registration.cardgenerator.qrshow sheet -o qr_codes.pdf
+    python -m registration.cardgenerator.qrshow sheet -o qr_new.pdf --where '"NIP Unizar" > 900000'
+    python -m registration.cardgenerator.qrshow show <uuid> <uuid>
+"""
+import argparse
+import hashlib
+import os
 import cv2
 import qrcode
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from PIL import Image, ImageDraw, ImageFont
+
+# Matrices computed so far, keyed by the SHA-1 of the encoded string and kept
+# in CACHE_FILE between runs
+CACHE_FILE = Path(os.environ.get('ESMERALDA_QR_CACHE', 'images/qr_cache.npz'))
+_QR_CACHE: dict[str, np.ndarray] | None = None
+# Below this many missing codes a process pool costs more than it saves
+PARALLEL_THRESHOLD = 64
+
+
+def _key(data:str) -> str:
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def _cache() -> dict[str, np.ndarray]:
+    global _QR_CACHE
+    if _QR_CACHE is None:
+        _QR_CACHE = {}
+        if CACHE_FILE.exists():
+            try:
+                with np.load(CACHE_FILE) as saved:
+                    _QR_CACHE.update(saved.items())
+            except (OSError, ValueError) as e:
+                print('Ignoring unreadable QR cache', CACHE_FILE, '-', e)
+    return _QR_CACHE
+
+
+def _save_cache():
+    CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = CACHE_FILE.with_name(CACHE_FILE.name + '.part')
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, **_cache())
+    os.replace(tmp, CACHE_FILE)
+
+
+def _make_matrix(data:str) -> np.ndarray:
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    return np.array(qr.get_matrix(), dtype=bool)
+
+
+def qr_matrices(data_list, workers=None, persist=True) -> list[np.ndarray]:
+    """
+    Returns the QR module matrix (True = black, border included) for each item.
+
+    Results are cached per string in CACHE_FILE, so building the same sheet
+    again, also in a later run, only pays for the tiling. Large batches of new
+    codes are computed in a process pool. With persist=False new codes are
+    only kept in memory.
+    """
+    cache = _cache()
+    data = [str(d) for d in data_list]
+    keys = [_key(d) for d in data]
+    missing = {k: d for k, d in zip(keys, data) if k not in cache}
+    if len(missing) >= PARALLEL_THRESHOLD and workers != 1:
+        with ProcessPoolExecutor(workers) as pool:
+            cache.update(zip(missing, pool.map(_make_matrix, missing.values(), chunksize=32)))
+    else:
+        cache.update((k, _make_matrix(d)) for k, d in missing.items())
+    if missing and persist:
+        _save_cache()
+    return [cache[k] for k in keys]
+
+
+def qr_contact_sheets(data_list, output_file, labels=None, columns=5, rows=7,
+                      module_px=6, label_px=28, workers=None) -> list[Path]:
+    """
+    Tiles the QR codes of data_list into labelled pages.
+
+    Args:
+        data_list (list): Strings (e.g. uuids) to encode.
+        output_file (Path): '.pdf' writes one multi-page PDF, anything else
+            writes one image per page named <stem>_<page><suffix>.
+        labels (list): Text printed under each code. Defaults to the data.
+        columns, rows (int): Codes per page.
+        module_px (int): Pixels per QR module.
+        label_px (int): Height of the label strip under each code.
+
+    Returns:
+        list[Path]: The files written.
+    """
+    output_file = Path(output_file)
+    labels = [str(l) for l in (labels if labels is not None else data_list)]
+    matrices = qr_matrices(data_list, workers=workers)
+    if not matrices:
+        return []
+
+    # Pad every code to the largest version so they tile as one array
+    size = max(m.shape[0] for m in matrices)
+    per_page = columns * rows
+    n_pages = -(-len(matrices) // per_page)
+    stack = np.zeros((n_pages * per_page, size, size), dtype=bool)
+    for i, m in enumerate(matrices):
+        offset = (size - m.shape[0]) // 2
+        stack[i, offset:offset + m.shape[0], offset:offset + m.shape[0]] = m
+
+    # Black modules -> 0, white -> 255, then scale each module up
+    tiles = np.where(stack, 0, 255).astype(np.uint8)
+    tiles = tiles.repeat(module_px, axis=1).repeat(module_px, axis=2)
+    tile = size * module_px
+    tiles = np.pad(tiles, ((0, 0), (0, label_px), (0, 0)), constant_values=255)
+    pages = (
+        tiles.reshape(n_pages, rows, columns, tile + label_px, tile)
+        .transpose(0, 1, 3, 2, 4)
+        .reshape(n_pages, rows * (tile + label_px), columns * tile)
+    )
+
+    font = ImageFont.load_default()
+    images = []
+    for p, page in enumerate(pages):
+        img = Image.fromarray(page, mode='L')
+        draw = ImageDraw.Draw(img)
+        for i, label in enumerate(labels[p * per_page:(p + 1) * per_page]):
+            row, col = divmod(i, columns)
+            x = col * tile + tile // 2
+            y = row * (tile + label_px) + tile + label_px // 2
+            draw.text((x, y), label, fill=0, font=font, anchor='mm')
+        images.append(img)
+
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    if output_file.suffix.lower() == '.pdf':
+        images[0].save(output_file, save_all=True, append_images=images[1:], resolution=300)
+        return [output_file]
+    written = []
+    for p, img in enumerate(images):
+        page_file = output_file.with_name(f'{output_file.stem}_{p + 1}{output_file.suffix}')
+        img.save(page_file)
+        written.append(page_file)
+    return written
+
 
 def show_qr_codes(data_list):
     """
@@ -71,10 +219,26 @@ def show_qr_codes(data_list):
     print("\nAll QR codes have been shown.")
 
 if __name__ == "__main__":
-    # Example usage with a list of strings
-    from uuid import uuid4
-    my_data = [
-        uuid4()
-        for i in range(0,4)
-    ]
-    show_qr_codes(my_data)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['sheet', 'show'])
+    parser.add_argument('data', nargs='*', help='Strings to encode; defaults to the uuids in the registry')
+    parser.add_argument('-o', '--output', type=Path, default=Path('qr_codes.pdf'),
+                        help="Contact sheet file: '.pdf' for one document, '.png' for one image per page")
+    parser.add_argument('--where', help='SQL filter on the registry, e.g. \'"NIP Unizar" > 900000\'')
+    parser.add_argument('--columns', type=int, default=5)
+    parser.add_argument('--rows', type=int, default=7)
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    data, labels = list(args.data), None
+    if not data:
+        from registration.registry import StudentRegistry
+        with StudentRegistry() as registry:
+            students = registry.to_dataframe('uuid IS NOT NULL' + (f' AND ({args.where})' if args.where else ''))
+        data = students['uuid'].to_list()
+        labels = students['NIP Unizar'].astype(str).to_list()
+    if args.command == 'show':
+        show_qr_codes(data)
+    else:
+        for written in qr_contact_sheets(data, args.output, labels, args.columns, args.rows, workers=args.workers):
+            print(written)
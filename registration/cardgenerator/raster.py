@@ -0,0 +1,172 @@
+from functools import lru_cache
+from pathlib import Path
+from uuid import UUID
+
+from PIL import Image, ImageDraw, ImageFont
+
+from registration.cardgenerator.cardgenerator import (
+    BACKGROUNDS, FONTS, RESOURCES, STROKE_COLORS, CardOptions
+)
+
+# Same layout as generate_card, in millimetres from the bottom-left corner
+CARD_SIZE = (85, 54)
+LOGO_BOX = (5, 39, 36.8, 36.8 * 443 / float(1631))
+FRAME_BOX = (49.1, 11, 74, 43)
+PHOTO_BOX = (49.6, 11.5, 23.9, 31)
+SERIAL_POS = (74, 5)
+NAME_POS = (8, 21)
+DEPARTMENT_POS = (8, 12)
+TEXT_WIDTH = 38
+# reportlab's 'Normal' style keeps a 12pt leading whatever the font size
+LEADING = 12
+
+
+def mm_to_px(value:float, dpi:int) -> int:
+    return round(value * dpi / 25.4)
+
+
+def pt_to_px(value:float, dpi:int) -> int:
+    return round(value * dpi / 72)
+
+
+def cmyk_to_rgb(c:float, m:float, y:float, k:float) -> tuple[int, int, int]:
+    return (
+        round(255 * (1 - c) * (1 - k)),
+        round(255 * (1 - m) * (1 - k)),
+        round(255 * (1 - y) * (1 - k)),
+    )
+
+
+def _to_px(x:float, y:float, dpi:int) -> tuple[int, int]:
+    # PDF coordinates grow upwards, image rows grow downwards
+    return mm_to_px(x, dpi), mm_to_px(CARD_SIZE[1] - y, dpi)
+
+
+@lru_cache(maxsize=None)
+def _font(name:str, size_pt:float, dpi:int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(str(FONTS[name]), pt_to_px(size_pt, dpi))
+
+
+@lru_cache(maxsize=None)
+def _logo(dpi:int) -> Image.Image:
+    x, y, width, height = LOGO_BOX
+    logo = Image.open(RESOURCES / 'logo_vet.png').convert('RGBA')
+    # preserveAspectRatio=True: fit inside the box, centred
+    box_w, box_h = mm_to_px(width, dpi), mm_to_px(height, dpi)
+    scale = min(box_w / logo.width, box_h / logo.height)
+    return logo.resize(
+        (max(1, round(logo.width * scale)), max(1, round(logo.height * scale))),
+        Image.Resampling.LANCZOS,
+    )
+
+
+@lru_cache(maxsize=None)
+def card_base_layer(background:str, dpi:int) -> Image.Image:
+    """
+    Background, logo and photo frame for a background at a given DPI.
+
+    These are the same for every student, so they are composited once and
+    cached. Callers must copy the result before drawing on it.
+    """
+    size = (mm_to_px(CARD_SIZE[0], dpi), mm_to_px(CARD_SIZE[1], dpi))
+    base = Image.open(RESOURCES / BACKGROUNDS[background]).convert('RGB')
+    base = base.resize(size, Image.Resampling.LANCZOS)
+
+    x, y, width, height = LOGO_BOX
+    logo = _logo(dpi)
+    left, top = _to_px(x, y + height, dpi)
+    left += (mm_to_px(width, dpi) - logo.width) // 2
+    top += (mm_to_px(height, dpi) - logo.height) // 2
+    base.paste(logo, (left, top), logo)
+
+    draw = ImageDraw.Draw(base)
+    x0, y0, x1, y1 = FRAME_BOX
+    color = cmyk_to_rgb(*STROKE_COLORS[background])
+    line_width = max(1, pt_to_px(1, dpi))
+    for start, end in (
+        ((x0, y0), (x1, y0)),
+        ((x0, y1), (x1, y1)),
+        ((x0, y0), (x0, y1)),
+        ((x1, y0), (x1, y1)),
+    ):
+        draw.line([_to_px(*start, dpi), _to_px(*end, dpi)], fill=color, width=line_width)
+    return base
+
+
+def _wrap(text:str, font:ImageFont.FreeTypeFont, width:int) -> list[str]:
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split():
+            candidate = (line + ' ' + word).strip()
+            if line and font.getlength(candidate) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+def _draw_paragraph(draw:ImageDraw.ImageDraw, text:str, font_name:str, size_pt:float,
+                    position:tuple[float, float], dpi:int):
+    # Mimics Paragraph.wrap + drawOn: position is the bottom-left of the block
+    font = _font(font_name, size_pt, dpi)
+    lines = _wrap(text, font, mm_to_px(TEXT_WIDTH, dpi))
+    left, bottom = _to_px(*position, dpi)
+    top = bottom - pt_to_px(LEADING * len(lines), dpi)
+    for i, line in enumerate(lines):
+        baseline = top + pt_to_px(size_pt + i * LEADING, dpi)
+        draw.text((left, baseline), line, font=font, fill='black', anchor='ls')
+
+
+def render_card(
+    profile_picture:Path, serial_number:UUID,
+    name:str, surname:str, nip:str, department:str,
+    cardoptions:CardOptions, dpi:int = 300
+    ) -> Image.Image:
+    """
+    Renders a card straight to an RGB image at the given DPI.
+
+    Mirrors the layout of generate_card without going through a PDF.
+    """
+    card = card_base_layer(cardoptions.background, dpi).copy()
+
+    x, y, width, height = PHOTO_BOX
+    photo = Image.open(profile_picture).convert('RGB')
+    photo = photo.resize(
+        (mm_to_px(width, dpi), mm_to_px(height, dpi)), Image.Resampling.LANCZOS
+    )
+    card.paste(photo, _to_px(x, y + height, dpi))
+
+    draw = ImageDraw.Draw(card)
+    draw.text(
+        _to_px(*SERIAL_POS, dpi), str(serial_number).upper(),
+        font=_font('RobotoMono-Medium', 6, dpi), fill='black', anchor='rs',
+    )
+    _draw_paragraph(draw, name + ' ' + surname + '\n' + nip, 'Inter-ExtraBold', 8, NAME_POS, dpi)
+    _draw_paragraph(draw, department, 'Inter-ExtraLight', 7, DEPARTMENT_POS, dpi)
+    return card
+
+
+def generate_card_raster(
+    output_file:Path, profile_picture:Path, serial_number:UUID,
+    name:str, surname:str, nip:str, department:str,
+    cardoptions:CardOptions, dpi:int = 300
+    ):
+    """
+    Writes a card bitmap for card printers.
+
+    A '.rgb' or '.raw' output_file gets the bare RGB buffer (row-major, 3 bytes
+    per pixel); anything else is saved by Pillow with the DPI tagged in.
+    """
+    card = render_card(
+        profile_picture, serial_number, name, surname, nip, department,
+        cardoptions, dpi=dpi,
+    )
+    output_file = Path(output_file)
+    if output_file.suffix.lower() in ('.rgb', '.raw'):
+        output_file.write_bytes(card.tobytes())
+    else:
+        card.save(output_file, dpi=(dpi, dpi))
+    return output_file
@@ -0,0 +1,123 @@
+"""
+Parquet snapshots of the workbooks the access-control screens keep re-reading.
+
+Parsing an .xlsx with openpyxl takes seconds; reading the same table back from
+Parquet is near-instant and memory-mapped. read_excel_cached keeps a snapshot
+next to each workbook ('.INGRESS.xlsx.parquet') plus a small JSON stamp with
+the workbook's mtime, size and SHA-1, and only parses the workbook again when
+it has really changed. A touched but identical file just refreshes the stamp.
+
+Without pyarrow installed every read goes straight to pd.read_excel (and a
+warning says so once).
+"""
+import hashlib
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401  (pandas' Parquet engine)
+except ImportError:
+    pyarrow = None
+
+
+@lru_cache(maxsize=None)
+def _warn_no_pyarrow():
+    print('pyarrow is not installed: workbooks are parsed on every read (pip install pyarrow)')
+
+
+def snapshot_path(workbook:Path) -> Path:
+    workbook = Path(workbook)
+    return workbook.with_name(f'.{workbook.name}.parquet')
+
+
+def _stamp_path(workbook:Path) -> Path:
+    workbook = Path(workbook)
+    return workbook.with_name(f'.{workbook.name}.stamp.json')
+
+
+def _file_hash(path:Path) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stamp(workbook:Path, digest:str | None = None) -> dict:
+    stat = os.stat(workbook)
+    return {
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha1': digest or _file_hash(workbook),
+    }
+
+
+def _load_stamp(workbook:Path) -> dict | None:
+    try:
+        return json.loads(_stamp_path(workbook).read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _save_snapshot(df:pd.DataFrame, workbook:Path, stamp:dict):
+    snapshot = snapshot_path(workbook)
+    tmp = snapshot.with_name(snapshot.name + '.part')
+    try:
+        df.to_parquet(tmp, index=False)
+    except Exception as e:  # mixed-type object columns Arrow can't store
+        print('Not caching', workbook, '-', e)
+        tmp.unlink(missing_ok=True)
+        return
+    os.replace(tmp, snapshot)
+    _stamp_path(workbook).write_text(json.dumps(stamp))
+
+
+def _snapshot_is_current(workbook:Path) -> bool:
+    stamp = _load_stamp(workbook)
+    if stamp is None or not snapshot_path(workbook).exists():
+        return False
+    stat = os.stat(workbook)
+    if (stat.st_mtime_ns, stat.st_size) == (stamp['mtime_ns'], stamp['size']):
+        return True
+    if stat.st_size != stamp['size']:
+        return False
+    # Same size, new mtime: only trust the snapshot if the bytes are the same
+    digest = _file_hash(workbook)
+    if digest != stamp['sha1']:
+        return False
+    _stamp_path(workbook).write_text(json.dumps(_stamp(workbook, digest)))
+    return True
+
+
+def read_excel_cached(workbook:Path, **kwargs) -> pd.DataFrame:
+    """
+    pd.read_excel(workbook, **kwargs), served from the Parquet snapshot when
+    the workbook hasn't changed since it was taken. Raises FileNotFoundError
+    like pd.read_excel if the workbook is missing.
+    """
+    workbook = Path(workbook)
+    if not workbook.exists():
+        raise FileNotFoundError(workbook)
+    if pyarrow is None:
+        _warn_no_pyarrow()
+        return pd.read_excel(workbook, **kwargs)
+    if kwargs:
+        return pd.read_excel(workbook, **kwargs)
+    if _snapshot_is_current(workbook):
+        return pd.read_parquet(snapshot_path(workbook), memory_map=True)
+    stamp = _stamp(workbook)
+    df = pd.read_excel(workbook)
+    _save_snapshot(df, workbook, stamp)
+    return df
+
+
+def to_excel_cached(df:pd.DataFrame, workbook:Path):
+    """Writes df to workbook and refreshes its snapshot, so the next read doesn't parse it back."""
+    workbook = Path(workbook)
+    df.to_excel(workbook, index=False)
+    if pyarrow is not None:
+        _save_snapshot(df, workbook, _stamp(workbook))
@@ -11,6 +11,8 @@ from dataclasses import fields
 import pandas as pd
 from typing import Dict, Any, List, Literal
 from registration.cardgenerator.cardgenerator import generate_card, CardOptions
+from registration.cardgenerator.cardindex import CARD_FOLDER, default_card_index
+from registration.registry import REGISTRY_FILE, StudentRegistry
 
 # Import the AccessControlWidget and related functions
 from registration.access_control_widget import AccessControlWidget, ingress_logic, ndef_decode, NTAG215Observer, toHexString
@@ -18,16 +20,13 @@ from registration.access_control_widget import AccessControlWidget, ingress_logi
 # --- Functions from ui.py ---
 def load_data(file_path: str) -> (Dict[Any, Dict[str, Any]], List[Any]):
     """
-    Loads data from an Excel file and returns a dictionary mapping NIPs to data
-    and a sorted list of NIPs.
+    Loads the students in the registry and returns a dictionary mapping NIPs to
+    data and a sorted list of NIPs.
     """
-    try:
-        df = pd.read_excel(file_path)
-        nip_to_data = {row['NIP Unizar']: row for index, row in df.iterrows()}
-        return nip_to_data, sorted(list(nip_to_data.keys()))
-    except FileNotFoundError:
-        print(f"Error: The file '{file_path}' was not found.")
-        return {}, []
+    with StudentRegistry(file_path) as registry:
+        df = registry.to_dataframe()
+    nip_to_data = {row['NIP Unizar']: row for index, row in df.iterrows()}
+    return nip_to_data, sorted(list(nip_to_data.keys()))
 
 def show_qr(uuid_str):
     qr = qrcode.QRCode(version=1, box_size=10, border=4)
@@ -50,12 +49,12 @@ def show_pdf_preview(pdf_path):
 
 # --- Main application class ---
 class IDCardViewerApp:
-    def __init__(self, master, data, nips, excel_file):
+    def __init__(self, master, data, nips, registry_file):
         self.master = master
         self.master.title("ID Card Viewer & Access Control")
         self.data = data
         self.nips = nips
-        self.excel_file = excel_file
+        self.registry_file = registry_file
         self.current_nip_index = 0
         self.card_options = CardOptions()
         self.option_vars = {}
@@ -63,7 +62,7 @@ class IDCardViewerApp:
         self.create_widgets()
         
         # Initialize the AccessControlWidget and pass 'self' to it
-        self.access_control_widget = ModifiedAccessControlWidget(self.main_frame, self, 'INGRESS.xlsx', 'database.xlsx')
+        self.access_control_widget = ModifiedAccessControlWidget(self.main_frame, self, 'INGRESS.xlsx', str(REGISTRY_FILE))
         self.access_control_widget.pack(side=tk.BOTTOM, fill='x', padx=10, pady=10)
 
         # Bindings for navigation
@@ -197,7 +196,7 @@ class IDCardViewerApp:
     def update_display(self, nip):
         student_data = self.data[nip]
         uuid = str(student_data['uuid'])
-        pdf_path = Path("output_cards") / f"{nip}.pdf"
+        pdf_path = default_card_index().card_file(nip)
 
         self.info_text.config(state="normal")
         self.info_text.delete(1.0, tk.END)
@@ -210,7 +209,7 @@ class IDCardViewerApp:
         self.qr_label.configure(image=qr_photo)
         self.qr_label.image = qr_photo
 
-        if not pdf_path.exists():
+        if pdf_path is None or student_data.get('card_stale') == 1:
             template_path = Path("output_cards") / "template.pdf"
             if template_path.exists():
                 pdf_image = show_pdf_preview(str(template_path))
@@ -233,7 +232,7 @@ class IDCardViewerApp:
     def generate_card_and_display(self):
         nip = self.nips[self.current_nip_index]
         row = self.data[nip]
-        pdf_path = Path("output_cards") / f"{nip}.pdf"
+        pdf_path = CARD_FOLDER / f"{nip}.pdf"
 
         loading_label = tk.Label(self.main_frame, text="Generating ID card...", font=("Arial", 16))
         loading_label.pack(pady=10)
@@ -247,9 +246,14 @@ class IDCardViewerApp:
             str(row['Apellidos']),
             str(row['NIP Unizar']),
             str(row['Estudios Matriculados']),
-            self.card_options
+            self.card_options,
+            card_index=default_card_index(),
         )
 
+        with StudentRegistry(self.registry_file) as registry:
+            registry.mark_cards_stale([nip], stale=False)
+        row['card_stale'] = 0
+
         loading_label.pack_forget()
         self.update_display(nip)
 
@@ -260,7 +264,7 @@ class IDCardViewerApp:
     def reload_database(self):
         current_nip = self.nip_selector.get()
         
-        self.data, self.nips = load_data(self.excel_file)
+        self.data, self.nips = load_data(self.registry_file)
         
         self.nip_selector['values'] = self.nips
         
@@ -274,8 +278,8 @@ class IDCardViewerApp:
         
     def open_card(self):
         nip = self.nips[self.current_nip_index]
-        pdf_path = Path("output_cards") / f"{nip}.pdf"
-        if pdf_path.exists():
+        pdf_path = default_card_index().card_file(nip)
+        if pdf_path is not None:
             try:
                 if os.name == 'nt':
                     os.startfile(str(pdf_path))
@@ -298,7 +302,7 @@ class IDCardViewerApp:
         action = 1 if self.access_control_widget.mode.get() == 'entry' else 0
         
         # Call the ingress logic function directly
-        response = ingress_logic(uuid, action, self.access_control_widget.df_ingress, self.access_control_widget.df_student_data)
+        response = ingress_logic(uuid, action, self.access_control_widget.df_ingress, self.access_control_widget.registry)
         
         # Update the UI of the AccessControlWidget
         self.access_control_widget.update_ui(response['result'], response['message'], response['student_data'], uuid)
@@ -375,7 +379,7 @@ def on_card_read_and_select(self, uuid: str):
     """Callback to handle a successful card read and select the student."""
     # First, handle the access control logic
     action = 1 if self.access_control_widget.mode.get() == 'entry' else 0
-    response = ingress_logic(uuid, action, self.access_control_widget.df_ingress, self.access_control_widget.df_student_data)
+    response = ingress_logic(uuid, action, self.access_control_widget.df_ingress, self.access_control_widget.registry)
     
     # Update the access control widget's UI
     self.access_control_widget.update_ui(response['result'], response['message'], response['student_data'], uuid)
@@ -384,10 +388,9 @@ def on_card_read_and_select(self, uuid: str):
     self.access_control_widget.df_ingress = self.access_control_widget.load_data(self.access_control_widget.ingress_file)
 
     # Now, find the NIP for the given UUID and update the UI
-    student_data_df = self.access_control_widget.df_student_data
-    matched_student = student_data_df[student_data_df['uuid'] == uuid]
-    if not matched_student.empty:
-        nip_from_uuid = matched_student.iloc[0]['NIP Unizar']
+    matched_student = self.access_control_widget.registry.get_by_uuid(uuid)
+    if matched_student is not None:
+        nip_from_uuid = matched_student['NIP Unizar']
         if nip_from_uuid in self.nips:
             # Update the combobox and display
             self.current_nip_index = self.nips.index(nip_from_uuid)
@@ -416,8 +419,8 @@ class ModifiedAccessControlWidget(AccessControlWidget):
 IDCardViewerApp.on_card_read_and_select = on_card_read_and_select
 
 if __name__ == "__main__":
-    if not os.path.exists('database.xlsx'):
-        print("Creating mock database.xlsx for demonstration...")
+    if not os.path.exists(REGISTRY_FILE):
+        print("Creating mock registry for demonstration...")
         mock_data_students = {
             'NIP Unizar': [123456, 789012, 112233],
             'uuid': ['76d452ab-89ca-4d0a-a2d1-2ffa9ab61117', 'another-uuid-for-testing', 'some-other-uuid'],
@@ -427,13 +430,13 @@ if __name__ == "__main__":
             'Fotografia': ['path/to/photo1.jpg', 'path/to/photo2.jpg', 'path/to/photo3.jpg']
         }
         df_students = pd.DataFrame(mock_data_students)
-        df_students.to_excel('database.xlsx', index=False)
+        StudentRegistry(REGISTRY_FILE).upsert(df_students)
 
-    excel_file = 'database.xlsx'
-    nip_data, nips = load_data(excel_file)
+    registry_file = str(REGISTRY_FILE)
+    nip_data, nips = load_data(registry_file)
     
     root = tk.Tk()
-    app = IDCardViewerApp(root, nip_data, nips, excel_file)
+    app = IDCardViewerApp(root, nip_data, nips, registry_file)
     
     def on_closing():
         app.access_control_widget.destroy_monitor()
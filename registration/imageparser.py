@@ -1,20 +1,238 @@
+import os
+import time
 import cv2
-import face_detection
 import requests as req
+import numpy as np
 import pandas as pd
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
-
-from torch._prims_common import elementwise_dtypes
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 database_file = "/home/steve/Projects/TarjetasPlazoleta/opnform/tarjetas-plazoleta-veterinaria-i41yoc-1756572978321-submissions.csv"
 
-def detect_face(image:Path, detector):
-    img = cv2.imread(image)
+# Any face_detection model name (RetinaNetMobileNetV1 is much lighter than DSFD
+# on CPU), or the path of a model exported with registration.onnxdetector
+DETECTOR_NAME = os.environ.get('ESMERALDA_DETECTOR', 'DSFDDetector')
+
+
+def get_detector(name:str | None = None):
+    """
+    Returns the face detector, building it on first use.
+
+    face_detection pulls in torch and the model weights, so nothing is loaded
+    until a photo actually needs detection; later calls reuse the same model.
+    """
+    return _build_detector(name or DETECTOR_NAME)
+
+
+@lru_cache(maxsize=None)
+def _build_detector(name:str):
+    print('Loading face detector', name)
+    if name.endswith('.onnx'):
+        from registration.onnxdetector import OnnxFaceDetector
+        return OnnxFaceDetector(
+            name,
+            max_resolution=1080,
+            confidence_threshold=.5,
+            nms_iou_threshold=.3
+        )
+    import face_detection
+    return face_detection.build_detector(
+        name,
+        max_resolution=1080,
+        confidence_threshold=.5, 
+        nms_iou_threshold=.3
+    )
+
+
+# libjpeg can decode straight to 1/2, 1/4 or 1/8 size, far cheaper than a full decode
+REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def read_image(image:Path | np.ndarray, reduce:int = 1) -> np.ndarray | None:
+    """Decodes image (BGR) at 1/reduce of its size; arrays are passed through."""
+    if isinstance(image, np.ndarray):
+        return image
+    return cv2.imread(str(image), REDUCED_READ_FLAGS[reduce])
+
+
+def decode_reduction(image:Path, min_size:int) -> int:
+    """
+    Largest reduce for read_image that keeps the longer side of image at least
+    min_size (and the shorter one at least MIN_PHOTO_SIDE). Only reads the
+    file's header.
+    """
+    try:
+        with Image.open(image) as header:
+            w, h = header.size
+    except (OSError, ValueError):
+        return 1
+    for reduce in sorted(REDUCED_READ_FLAGS, reverse=True):
+        if max(w, h) // reduce >= min_size and min(w, h) // reduce >= MIN_PHOTO_SIDE:
+            return reduce
+    return 1
+
+
+def detect_face(image:Path | np.ndarray, detector, detect_size:int | None = None):
+    """
+    Face boxes for image, in its own coordinates.
+
+    With detect_size, images larger than that are shrunk before detection and
+    the boxes scaled back up, which is much cheaper on 12 MP phone photos.
+    """
+    img = read_image(image)
+    scale = 1.0
+    if detect_size and max(img.shape[:2]) > detect_size:
+        scale = detect_size / max(img.shape[:2])
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
     dets = detector.detect(
             img[:, :, ::-1]
         )[:, :4]
-    return dets
+    return dets / scale
+
+
+# Photo quality gate, evaluated on a copy shrunk to QUALITY_SIZE
+QUALITY_SIZE = 512
+MIN_PHOTO_SIDE = 300
+MAX_ASPECT = 4 / 3  # width / height; wider than this is not a portrait
+MIN_SHARPNESS = 30.0  # variance of the Laplacian
+MIN_BRIGHTNESS = 40
+MAX_BRIGHTNESS = 225
+MAX_CLIPPED = 0.5  # fraction of pixels that are pure black or pure white
+
+
+def check_quality(image:Path | np.ndarray) -> list[str]:
+    """
+    Cheap checks run before the detector. Returns why the photo can't be used,
+    or an empty list if it passes.
+    """
+    img = read_image(image)
+    if img is None:
+        return ['unreadable image']
+    h, w = img.shape[:2]
+    reasons = []
+    if min(h, w) < MIN_PHOTO_SIDE:
+        reasons.append(f'too small ({w}x{h})')
+    if w / h > MAX_ASPECT:
+        reasons.append(f'not a portrait ({w}x{h})')
+
+    # Shrink first so the colour conversion only touches QUALITY_SIZE pixels
+    scale = min(1.0, QUALITY_SIZE / max(h, w))
+    if scale < 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    sharpness = cv2.Laplacian(gray, cv2.CV_64F).var()
+    if sharpness < MIN_SHARPNESS:
+        reasons.append(f'blurry (sharpness {sharpness:.0f})')
+    histogram = np.bincount(gray.ravel(), minlength=256)
+    brightness = (histogram * np.arange(256)).sum() / gray.size
+    clipped = (histogram[:8].sum() + histogram[-8:].sum()) / gray.size
+    if brightness < MIN_BRIGHTNESS:
+        reasons.append(f'too dark (mean {brightness:.0f})')
+    elif brightness > MAX_BRIGHTNESS:
+        reasons.append(f'overexposed (mean {brightness:.0f})')
+    if clipped > MAX_CLIPPED:
+        reasons.append(f'{clipped:.0%} of pixels clipped')
+    return reasons
+
+
+def detect_and_crop(image:Path | np.ndarray, detector, output_size = (250, 250), percent_inc = 75,
+                    detect_size:int = 1080, reduce:int = 1):
+    """
+    Detects the face and crops it around it, decoding the file only once.
+
+    Detection runs on a copy shrunk to detect_size and the crop is taken from
+    the decoded array. reduce > 1 decodes at 1/reduce resolution in the first
+    place; only use it when photos are much larger than output_size needs.
+    """
+    img = read_image(image, reduce)
+    dets = detect_face(img, detector, detect_size=detect_size)
+    return crop_image(img, dets[0, :], output_size=output_size, percent_inc=percent_inc)
+
+
+# Rough peak memory per pixel of a DSFD forward pass (input, feature maps, priors)
+DETECTOR_BYTES_PER_PIXEL = 400
+MAX_BATCH_SIZE = 16
+
+
+def set_torch_threads(threads:int):
+    import torch
+    torch.set_num_threads(threads)
+
+
+def available_memory() -> int:
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):  # Windows
+        return 2 * 1024 ** 3
+
+
+def detection_batch_size(size:int) -> int:
+    """How many size x size images fit in half of the free memory, capped at MAX_BATCH_SIZE."""
+    per_image = size * size * DETECTOR_BYTES_PER_PIXEL
+    return max(1, min(MAX_BATCH_SIZE, available_memory() // 2 // per_image))
+
+
+def letterbox(img:np.ndarray, size:int) -> tuple[np.ndarray, float, int, int]:
+    """
+    Scales img to fit a size x size square, keeping its aspect ratio, and pads
+    the rest with black. Returns the square and the scale and x/y offsets
+    needed to map boxes back to the original image.
+    """
+    h, w = img.shape[:2]
+    scale = size / max(h, w)
+    new_w, new_h = round(w * scale), round(h * scale)
+    resized = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    boxed = np.zeros((size, size, 3), dtype=img.dtype)
+    x, y = (size - new_w) // 2, (size - new_h) // 2
+    boxed[y:y + new_h, x:x + new_w] = resized
+    return boxed, scale, x, y
+
+
+def detect_faces_batched(images:list[Path | np.ndarray], detector, size:int = 1080,
+                         batch_size:int | None = None, threads:int | None = None) -> list[np.ndarray | None]:
+    """
+    Runs the detector over many photos at once.
+
+    Each photo is letterboxed to size x size so they can be stacked into one
+    batch; batch_size defaults to what fits in free memory. Returns, per
+    image, the detections ([x0, y0, x1, y1, score] rows) in the
+    original image's coordinates, or None if the image could not be read.
+    """
+    if threads:
+        set_torch_threads(threads)
+    batch_size = batch_size or detection_batch_size(size)
+    results = []
+    for start in range(0, len(images), batch_size):
+        batch, transforms = [], []
+        for image in images[start:start + batch_size]:
+            img = read_image(image)
+            if img is None:
+                transforms.append(None)
+                continue
+            boxed, scale, x, y = letterbox(img[:, :, ::-1], size)
+            batch.append(boxed)
+            transforms.append((scale, x, y))
+        dets = iter(detector.batched_detect(np.stack(batch)) if batch else [])
+        for transform in transforms:
+            if transform is None:
+                results.append(None)
+                continue
+            scale, x, y = transform
+            boxes = next(dets).copy()
+            boxes[:, [0, 2]] = (boxes[:, [0, 2]] - x) / scale
+            boxes[:, [1, 3]] = (boxes[:, [1, 3]] - y) / scale
+            results.append(boxes)
+    return results
 
 
 def draw_face(im, bbox, window_name = 'preview'):
@@ -30,77 +248,172 @@ def draw_face(im, bbox, window_name = 'preview'):
             break
 
 
-def crop_image(image, face, output_size = (250, 250), percent_inc = 75): 
-    image = cv2.imread(image)
+def crop_windows(faces:np.ndarray, output_size = (250, 250), percent_inc = 75) -> np.ndarray:
+    """
+    Crop rectangles (xmin, ymin, xmax, ymax) for an N x 4 array of face boxes.
+
+    Each box is grown by percent_inc and then widened or heightened to the
+    aspect ratio of output_size. Works on any number of boxes at once.
+    """
+    faces = np.asarray(faces, dtype=np.float64).reshape(-1, 4)
     output_ratio  = output_size[1] / output_size[0]
-    #draw_faces(image, (face[0], face[1], face[2], face[3]), window_name='torch_output')
-    real_inc_x = (face[2] - face[0]) * (1 + (percent_inc * 0.01))
-    real_inc_y = (face[3] - face[1]) * (1 + (percent_inc * 0.01))
-    diff_x = (real_inc_x - (face[2] - face[0])) / 2
-    diff_y = (real_inc_y - (face[3] - face[1])) / 2
-    xmin = face[0] - diff_x
-    ymin = face[1] - diff_y
-    xmax = face[2] + diff_x
-    ymax = face[3] + diff_y
-    #draw_faces(image, (xmin, ymin, xmax, ymax), window_name='increase 25%')
-    w = (xmax-xmin)
-    h = (ymax-ymin)
-    if w>h:
-        diference = ( (w * output_ratio) - h ) / 2
-        ymin = ymin - diference
-        ymax = ymax + diference
-    else:
-        diference = ( (h / output_ratio) - w ) / 2
-        xmin = xmin - diference
-        xmax = xmax + diference
-    #draw_faces(image, (xmin, ymin, xmax, ymax), window_name='Adapt to ratio')
+    w = (faces[:, 2] - faces[:, 0]) * (1 + (percent_inc * 0.01))
+    h = (faces[:, 3] - faces[:, 1]) * (1 + (percent_inc * 0.01))
+    diff_x = (w - (faces[:, 2] - faces[:, 0])) / 2
+    diff_y = (h - (faces[:, 3] - faces[:, 1])) / 2
+    xmin = faces[:, 0] - diff_x
+    ymin = faces[:, 1] - diff_y
+    xmax = faces[:, 2] + diff_x
+    ymax = faces[:, 3] + diff_y
+    wide = w > h
+    diference_y = np.where(wide, ((w * output_ratio) - h) / 2, 0)
+    diference_x = np.where(wide, 0, ((h / output_ratio) - w) / 2)
+    return np.stack([
+        xmin - diference_x, ymin - diference_y,
+        xmax + diference_x, ymax + diference_y,
+    ], axis=1)
+
+
+def crop_window(image:np.ndarray, window, output_size = (250, 250)):
+    xmin, ymin, xmax, ymax = window
     maxh, maxw = image.shape[:2]
     crop_img = image[
         max(int(ymin), 0):min(int(ymax), maxh), 
         max(int(xmin), 0):min(int(xmax), maxw)
         ]
-    #draw_faces(crop_img, (0, 0, 0, 0), window_name='Adapt to ratio')
-    cropped = cv2.resize(crop_img, output_size)
-    return cropped
+    return cv2.resize(crop_img, output_size)
+
+
+def crop_image(image, face, output_size = (250, 250), percent_inc = 75): 
+    image = read_image(image)
+    window = crop_windows(np.asarray(face)[:4], output_size, percent_inc)[0]
+    return crop_window(image, window, output_size)
     
 
-def download_images(database_file:Path | pd.DataFrame):
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_TIMEOUT = (5, 30)  # connect, read (seconds)
+DOWNLOAD_RETRIES = 3
+MAX_IMAGE_BYTES = 25 * 1024 * 1024
+BASE_FOLDER = Path("images/base")
+
+
+def create_session(pool_size:int = DOWNLOAD_WORKERS, retries:int = DOWNLOAD_RETRIES,
+                   backoff:float = 0.5) -> req.Session:
+    """
+    Session shared by all download threads, with one pooled connection per
+    worker and urllib3 retries with exponential backoff on connection errors
+    and 429/5xx responses.
+    """
+    session = req.Session()
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def image_path(nip, url:str, base_folder:Path = BASE_FOLDER) -> Path:
+    file_extension = url.split('?signature')[0].split('.')[-1]
+    return base_folder / (str(nip) + '.' + file_extension)
+
+
+def download_image(url:str, output_file:Path, session:req.Session,
+                   max_bytes:int = MAX_IMAGE_BYTES, retries:int = DOWNLOAD_RETRIES,
+                   backoff:float = 0.5) -> Path:
+    """
+    Streams url to output_file through a temporary '.part' file that is
+    renamed into place only once complete, so a failed download never leaves
+    a truncated image behind. Responses larger than max_bytes are rejected.
+    """
+    tmp = output_file.with_name(output_file.name + '.part')
+    try:
+        for attempt in range(retries + 1):
+            try:
+                with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                    response.raise_for_status()
+                    if int(response.headers.get('Content-Length') or 0) > max_bytes:
+                        raise ValueError(f'{url} is larger than {max_bytes} bytes')
+                    written = 0
+                    with open(tmp, 'wb') as f:
+                        for chunk in response.iter_content(64 * 1024):
+                            written += len(chunk)
+                            if written > max_bytes:
+                                raise ValueError(f'{url} is larger than {max_bytes} bytes')
+                            f.write(chunk)
+            except req.exceptions.ChunkedEncodingError:
+                # The adapter already retries failed connections and responses;
+                # this only covers a body cut off mid-stream, which it doesn't
+                if attempt == retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+            else:
+                break
+        os.replace(tmp, output_file)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return output_file
+
+
+def iter_downloads(database_file:Path | pd.DataFrame, workers:int = DOWNLOAD_WORKERS,
+                   session:req.Session | None = None):
+    """
+    Downloads every row's 'Fotografia' concurrently and yields
+    (position, nip, file) as each one finishes, so later stages can start on
+    a photo while the rest are still downloading. file is None on failure.
+    """
     if not type(database_file) == pd.DataFrame :
         db  = pd.read_csv(database_file)
     else:
         db = database_file
-    base_folder = Path("images/base")
-    files = []
-    for index, row in db.iterrows():
-        nip = row['NIP Unizar']
-        image = row['Fotografia']
-        file_extension = image.split('?signature')[0].split('.')[-1]
-        file_name = str(nip) + '.' + file_extension
-        output_file = base_folder / file_name
-        if output_file.exists():
-            print(nip, 'exists. Skipping...')
-        else:
-            print(nip)
-            response = req.get(image)
-            output_file.write_bytes(response.content)
-        files.append(output_file)
+    BASE_FOLDER.mkdir(parents=True, exist_ok=True)
+    session = session or create_session(pool_size=workers)
+    with ThreadPoolExecutor(workers) as pool:
+        futures = {}
+        for position, (nip, image) in enumerate(zip(db['NIP Unizar'], db['Fotografia'])):
+            if not isinstance(image, str) or not image.strip():
+                print('No photo URL for', nip)
+                yield position, nip, None
+                continue
+            output_file = image_path(nip, image)
+            if output_file.exists():
+                print(nip, 'exists. Skipping...')
+                yield position, nip, output_file
+            else:
+                futures[pool.submit(download_image, image, output_file, session)] = (position, nip)
+        for future in as_completed(futures):
+            position, nip = futures[future]
+            try:
+                output_file = future.result()
+            except Exception as e:
+                print('Could not download photo for', nip, e)
+                output_file = None
+            else:
+                print(nip)
+            yield position, nip, output_file
+
+
+def download_images(database_file:Path | pd.DataFrame, workers:int = DOWNLOAD_WORKERS):
+    """Downloads all photos and returns their paths in row order (None on failure)."""
+    if not type(database_file) == pd.DataFrame :
+        database_file  = pd.read_csv(database_file)
+    files = [None] * len(database_file)
+    for position, _, output_file in iter_downloads(database_file, workers=workers):
+        files[position] = output_file
     return files
 
 
 if __name__ == '__main__':
     #download_images(Path(r"F:\tarjetas-plazoleta-veterinaria-i41yoc-1756807830330-submissions.csv"))
-    detector = face_detection.build_detector(
-        "DSFDDetector",
-        max_resolution=1080,
-        confidence_threshold=.5, 
-        nms_iou_threshold=.3
-    )
+    detector = get_detector()
     output_size = (413,531)
     for image in Path('images/base/').glob('*'):
             try:
-                dets = detect_face(image, detector)
-                face = dets[0, :]
-                cropped = crop_image(image, face, output_size=output_size)
+                cropped = detect_and_crop(image, detector, output_size=output_size)
             except:
                 print("No faces for image ", image.name)
             else:
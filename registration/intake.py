@@ -0,0 +1,132 @@
+"""
+Checkpointed intake of validated form responses into the registry.
+
+Rows go through the photo pipeline, uuid assignment and the registry commit in
+small batches, and each row's progress is written to an 'intake' table next to
+the students as soon as a stage finishes. If the watcher dies halfway, the
+next run finds the rows it had already committed unchanged (by row hash) and,
+for the rest, picks up from the last finished stage: a photo that was cropped
+is not fetched again and a uuid that was handed out is reused.
+
+Downloads, detections and crops are checkpointed by the photo store itself,
+which is saved after every batch.
+"""
+import time
+import uuid
+
+import pandas as pd
+
+from registration.registry import KEY, StudentRegistry
+from registration.sheetsync import PRINTED_COLUMNS, row_hashes
+from registration.validation import REASON_COLUMN
+
+INTAKE_BATCH = 16
+STAGES = ('validated', 'photo', 'uuid', 'committed')
+
+
+class IntakeLog:
+    """Per-row progress through STAGES, kept in the registry's database."""
+
+    def __init__(self, registry:StudentRegistry):
+        self.registry = registry
+        self.conn = registry.conn
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS intake (nip INTEGER PRIMARY KEY, row_hash TEXT, stage TEXT, '
+            'photo TEXT, uuid TEXT, updated REAL)'
+        )
+        self.conn.commit()
+
+    def progress(self, nip, row_hash:str) -> dict:
+        """Stage reached by this version of the row ('' if none, or if the row changed since)."""
+        row = self.conn.execute(
+            'SELECT stage, photo, uuid FROM intake WHERE nip = ? AND row_hash = ?', (int(nip), row_hash)
+        ).fetchone()
+        if row is None:
+            return {'stage': '', 'photo': None, 'uuid': None}
+        return dict(zip(('stage', 'photo', 'uuid'), row))
+
+    def advance(self, entries:list[tuple], stage:str):
+        """Records stage for each (nip, row_hash, photo, uuid), keeping photo/uuid already known."""
+        with self.registry._lock, self.conn:
+            self.conn.executemany(
+                'INSERT INTO intake (nip, row_hash, stage, photo, uuid, updated) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(nip) DO UPDATE SET stage = excluded.stage, updated = excluded.updated, '
+                'photo = CASE WHEN intake.row_hash = excluded.row_hash THEN COALESCE(excluded.photo, intake.photo) ELSE excluded.photo END, '
+                'uuid = CASE WHEN intake.row_hash = excluded.row_hash THEN COALESCE(excluded.uuid, intake.uuid) ELSE excluded.uuid END, '
+                'row_hash = excluded.row_hash',
+                [(int(nip), h, stage, photo, uid, time.time()) for nip, h, photo, uid in entries],
+            )
+
+    def clear_committed(self):
+        with self.registry._lock, self.conn:
+            self.conn.execute("DELETE FROM intake WHERE stage = 'committed'")
+
+
+def run_intake(rows:pd.DataFrame, new_nips:set, registry:StudentRegistry, normalize_photos,
+               batch_size:int = INTAKE_BATCH, log:IntakeLog | None = None) -> pd.DataFrame:
+    """
+    Brings validated rows (with a 'row_hash' column) into the registry.
+
+    normalize_photos(df) fills df['Fotografia'] with the cropped photo (or
+    None) and may leave 'photo_rejections' and 'photo_duplicates' in df.attrs.
+    New NIPs get a uuid; the others are corrections and keep theirs, and their
+    card is marked stale if a printed field or the photo changed. Each batch is committed before the next one starts.
+    Returns the rows that could not be brought in, with a REASON_COLUMN, and
+    the photo duplicates found in its attrs.
+    """
+    log = log if log is not None else IntakeLog(registry)
+    failures = []
+    duplicates = {}
+    card_hashes = registry.card_hashes()
+    for start in range(0, len(rows), batch_size):
+        batch = rows.iloc[start:start + batch_size].copy()
+        # Taken while 'Fotografia' is still the URL, so a new photo counts as an edit
+        batch['card_hash'] = row_hashes(batch, PRINTED_COLUMNS)
+        keys = list(zip(batch[KEY], batch['row_hash']))
+        progress = [log.progress(nip, h) for nip, h in keys]
+        log.advance([(nip, h, None, None) for (nip, h), p in zip(keys, progress) if not p['stage']], 'validated')
+
+        # Photos: only for rows that haven't got one yet
+        photos = pd.Series([p['photo'] for p in progress], index=batch.index, dtype=object)
+        pending = photos.isna().to_numpy()
+        reasons = {}
+        if pending.any():
+            fetched = normalize_photos(batch[pending].copy())
+            photos[pending] = fetched['Fotografia'].to_numpy()
+            reasons = fetched.attrs.get('photo_rejections', {})
+            duplicates.update(fetched.attrs.get('photo_duplicates', {}))
+            log.advance([
+                (nip, h, str(photo), None)
+                for (nip, h), photo, todo in zip(keys, photos, pending)
+                if todo and pd.notna(photo)
+            ], 'photo')
+        batch['Fotografia'] = photos
+
+        # uuids: handed out once per new student, even across restarts
+        uuids = [
+            p['uuid'] or (str(uuid.uuid4()) if nip in new_nips else None)
+            for (nip, _), p in zip(keys, progress)
+        ]
+        log.advance([(nip, h, None, uid) for (nip, h), uid in zip(keys, uuids) if uid], 'uuid')
+
+        # Commit what is complete
+        failed = batch.isnull().any(axis=1).to_numpy()
+        batch['uuid'] = uuids
+        ok = batch[~failed]
+        new = ok[KEY].isin(new_nips).to_numpy()
+        corrected = ok[~new].drop(columns='uuid')
+        # Students synced before card hashes were kept just adopt the current one
+        stored = corrected[KEY].map(card_hashes)
+        reprint = stored.notna() & (stored != corrected['card_hash'])
+        registry.upsert(ok[new])
+        registry.upsert(corrected)
+        registry.mark_cards_stale(corrected.loc[reprint, KEY])
+        log.advance([(nip, h, None, None) for nip, h in zip(ok[KEY], ok['row_hash'])], 'committed')
+
+        rejected = batch[failed].drop(columns=['row_hash', 'card_hash', 'uuid'])
+        rejected[REASON_COLUMN] = rejected[KEY].map(reasons).fillna('Missing data')
+        failures.append(rejected)
+        print(f'Committed {len(ok)} of {min(start + batch_size, len(rows))}/{len(rows)} rows')
+    result = pd.concat(failures) if failures else pd.DataFrame()
+    result.attrs['photo_duplicates'] = duplicates
+    return result
@@ -0,0 +1,207 @@
+"""
+CPU face detector running an exported RetinaFace graph with onnxruntime.
+
+The registration machines have no GPU, so instead of running the torch model
+through face_detection we export RetinaNetMobileNetV1 once to ONNX (optionally
+int8-quantized) and run it with onnxruntime. OnnxFaceDetector has the same
+detect / batched_detect interface as face_detection's detectors, and
+imageparser.get_detector returns one whenever the detector name is a path to a
+.onnx file, e.g. ESMERALDA_DETECTOR=models/retinaface_mnet_int8.onnx.
+
+    python -m registration.onnxdetector export models/retinaface_mnet.onnx
+    python -m registration.onnxdetector compare labels.csv DSFDDetector models/retinaface_mnet_int8.onnx
+
+labels.csv has one labelled face per photo: file,x0,y0,x1,y1.
+"""
+import argparse
+import csv
+import os
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# RetinaFace MobileNet-0.25 anchors
+MIN_SIZES = [[16, 32], [64, 128], [256, 512]]
+STEPS = [8, 16, 32]
+VARIANCE = (0.1, 0.2)
+# The network expects BGR input with these channel means removed
+BGR_MEAN = np.array([104, 117, 123], dtype=np.float32)
+
+
+def prior_boxes(height:int, width:int) -> np.ndarray:
+    """Anchor centres and sizes (cx, cy, w, h), relative to the image size."""
+    priors = []
+    for min_sizes, step in zip(MIN_SIZES, STEPS):
+        rows, cols = int(np.ceil(height / step)), int(np.ceil(width / step))
+        cy, cx = np.meshgrid((np.arange(rows) + 0.5) * step / height,
+                             (np.arange(cols) + 0.5) * step / width, indexing='ij')
+        # Anchors are interleaved per cell: (cell0 s0, cell0 s1, cell1 s0, ...)
+        cell = np.stack([cx.ravel(), cy.ravel()], axis=1)
+        sizes = np.array([[s / width, s / height] for s in min_sizes], dtype=np.float64)
+        anchors = np.concatenate([
+            np.repeat(cell, len(min_sizes), axis=0),
+            np.tile(sizes, (len(cell), 1)),
+        ], axis=1)
+        priors.append(anchors)
+    return np.concatenate(priors).astype(np.float32)
+
+
+def decode_boxes(loc:np.ndarray, priors:np.ndarray) -> np.ndarray:
+    centres = priors[:, :2] + loc[:, :2] * VARIANCE[0] * priors[:, 2:]
+    sizes = priors[:, 2:] * np.exp(loc[:, 2:] * VARIANCE[1])
+    return np.concatenate([centres - sizes / 2, centres + sizes / 2], axis=1)
+
+
+class OnnxFaceDetector:
+    def __init__(self, model_path:Path, confidence_threshold:float = .5,
+                 nms_iou_threshold:float = .3, max_resolution:int = 1080,
+                 threads:int | None = None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or os.cpu_count() or 1
+        self.session = ort.InferenceSession(
+            str(model_path), options, providers=['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.confidence_threshold = confidence_threshold
+        self.nms_iou_threshold = nms_iou_threshold
+        self.max_resolution = max_resolution
+
+    def _postprocess(self, loc:np.ndarray, conf:np.ndarray, height:int, width:int) -> np.ndarray:
+        scores = conf[:, 1]
+        keep = scores > self.confidence_threshold
+        boxes = decode_boxes(loc[keep], prior_boxes(height, width)[keep])
+        boxes *= [width, height, width, height]
+        scores = scores[keep]
+        if not len(scores):
+            return np.zeros((0, 5), dtype=np.float32)
+        xywh = np.concatenate([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], axis=1)
+        idx = np.array(cv2.dnn.NMSBoxes(
+            xywh.tolist(), scores.tolist(), self.confidence_threshold, self.nms_iou_threshold
+        )).reshape(-1)
+        idx = idx[np.argsort(-scores[idx])]
+        return np.concatenate([boxes[idx], scores[idx, None]], axis=1).astype(np.float32)
+
+    def batched_detect(self, images:np.ndarray) -> list[np.ndarray]:
+        """images: N x H x W x 3 uint8 RGB. Returns [x0, y0, x1, y1, score] rows per image."""
+        _, height, width, _ = images.shape
+        scale = min(1.0, self.max_resolution / max(height, width))
+        if scale < 1:
+            images = np.stack([
+                cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                for img in images
+            ])
+        _, h, w, _ = images.shape
+        batch = images[..., ::-1].astype(np.float32) - BGR_MEAN
+        batch = np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+        loc, conf = self.session.run(None, {self.input_name: batch})[:2]
+        results = []
+        for i in range(len(images)):
+            dets = self._postprocess(loc[i], conf[i], h, w)
+            dets[:, :4] /= scale
+            results.append(dets)
+        return results
+
+    def detect(self, image:np.ndarray) -> np.ndarray:
+        return self.batched_detect(image[None])[0]
+
+
+def export_onnx(output:Path, quantize:bool = True, size:int = 640) -> list[Path]:
+    """
+    Exports face_detection's RetinaNetMobileNetV1 to ONNX with dynamic batch
+    and image size, plus an int8 dynamically quantized copy next to it.
+    """
+    import torch
+    from registration.imageparser import get_detector
+
+    class _Export(torch.nn.Module):
+        # Only boxes and (softmaxed) scores; landmarks are not used
+        def __init__(self, net):
+            super().__init__()
+            self.net = net
+
+        def forward(self, x):
+            loc, conf, _ = self.net(x)
+            return loc, conf
+
+    net = get_detector('RetinaNetMobileNetV1').net.eval().cpu()
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    torch.onnx.export(
+        _Export(net), torch.zeros(1, 3, size, size), str(output),
+        input_names=['image'], output_names=['loc', 'conf'],
+        dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                      'loc': {0: 'batch', 1: 'priors'}, 'conf': {0: 'batch', 1: 'priors'}},
+        opset_version=13,
+    )
+    written = [output]
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantized = output.with_name(output.stem + '_int8.onnx')
+        quantize_dynamic(str(output), str(quantized), weight_type=QuantType.QInt8)
+        written.append(quantized)
+    return written
+
+
+def _iou(a, b) -> float:
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0, x1 - x0) * max(0, y1 - y0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union else 0.0
+
+
+def compare_detectors(labels_file:Path, detector_names:list[str], detect_size:int = 1080) -> dict:
+    """
+    Runs each detector over the labelled photos and reports, per detector,
+    seconds per photo, mean IoU of the top box with the label, and the share
+    of photos whose top box overlaps the label with IoU >= 0.5.
+    """
+    from registration.imageparser import detect_face, get_detector, read_image
+
+    labels_file = Path(labels_file)
+    with open(labels_file, newline='') as f:
+        samples = [
+            (labels_file.parent / row['file'], [float(row[k]) for k in ('x0', 'y0', 'x1', 'y1')])
+            for row in csv.DictReader(f)
+        ]
+    images = [(read_image(path), box) for path, box in samples]
+    report = {}
+    for name in detector_names:
+        detector = get_detector(name)
+        detect_face(images[0][0], detector, detect_size=detect_size)  # warm-up
+        ious = []
+        start = time.perf_counter()
+        for img, box in images:
+            dets = detect_face(img, detector, detect_size=detect_size)
+            ious.append(_iou(dets[0], box) if len(dets) else 0.0)
+        elapsed = time.perf_counter() - start
+        report[name] = {
+            'seconds_per_photo': elapsed / len(images),
+            'mean_iou': float(np.mean(ious)),
+            'recall_at_0.5': float(np.mean(np.array(ious) >= 0.5)),
+        }
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export')
+    export.add_argument('output', type=Path)
+    export.add_argument('--no-quantize', action='store_true')
+    compare = commands.add_parser('compare')
+    compare.add_argument('labels', type=Path)
+    compare.add_argument('detectors', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        for path in export_onnx(args.output, quantize=not args.no_quantize):
+            print('Wrote', path)
+    else:
+        print(f"{'detector':<45}{'s/photo':>9}{'IoU':>7}{'recall':>8}")
+        for name, result in compare_detectors(args.labels, args.detectors).items():
+            print(f"{name:<45}{result['seconds_per_photo']:>9.3f}"
+                  f"{result['mean_iou']:>7.3f}{result['recall_at_0.5']:>8.1%}")
@@ -0,0 +1,119 @@
+"""
+Perceptual-hash index of normalized photos, to catch the same photo being
+used by more than one registration.
+
+Each crop gets a 64-bit difference hash (dHash). Hashes are kept in a uint64
+array next to the NIPs they belong to, and a query XORs one hash against the
+whole array and counts differing bits, so a lookup is a single vectorized pass
+instead of pairwise image comparisons.
+"""
+import os
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+INDEX_FILE = Path("images/store/phash.npz")
+# Bits out of 64 that may differ for two photos to count as the same picture
+DUPLICATE_DISTANCE = 6
+_BIT_WEIGHTS = (1 << np.arange(64, dtype=np.uint64)).astype(np.uint64)
+
+
+def dhash(image:np.ndarray) -> np.uint64:
+    """64-bit difference hash of a BGR or grayscale image."""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return np.uint64((bits.astype(np.uint64) * _BIT_WEIGHTS).sum())
+
+
+def hamming(hashes:np.ndarray, value:np.uint64) -> np.ndarray:
+    """Number of differing bits between value and every entry of hashes."""
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    if hasattr(np, 'bitwise_count'):  # numpy >= 2.0
+        return np.bitwise_count(xor)
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class PhashIndex:
+    def __init__(self, index_file:Path = INDEX_FILE):
+        self.index_file = Path(index_file)
+        self._lock = threading.Lock()
+        if self.index_file.exists():
+            data = np.load(self.index_file)
+            self.nips, self.hashes = data['nips'], data['hashes']
+        else:
+            self.nips = np.zeros(0, dtype=np.int64)
+            self.hashes = np.zeros(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.nips)
+
+    def save(self):
+        with self._lock:
+            self.index_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.index_file.with_name(self.index_file.stem + '.part.npz')
+            np.savez(tmp, nips=self.nips, hashes=self.hashes)
+            os.replace(tmp, self.index_file)
+
+    def add(self, nip, value:np.uint64):
+        """Sets the hash for nip, replacing any previous one."""
+        self.add_many([nip], [value])
+
+    def add_many(self, nips, values):
+        nips = np.asarray(nips, dtype=np.int64)
+        values = np.asarray(values, dtype=np.uint64)
+        with self._lock:
+            keep = ~np.isin(self.nips, nips)
+            self.nips = np.concatenate([self.nips[keep], nips])
+            self.hashes = np.concatenate([self.hashes[keep], values])
+
+    def get(self, nip) -> np.uint64 | None:
+        match = np.flatnonzero(self.nips == int(nip))
+        return self.hashes[match[0]] if len(match) else None
+
+    def query(self, value:np.uint64, max_distance:int = DUPLICATE_DISTANCE, exclude=None) -> list[tuple[int, int]]:
+        """(nip, distance) of every indexed photo within max_distance bits, closest first."""
+        distances = hamming(self.hashes, value)
+        mask = distances <= max_distance
+        if exclude is not None:
+            mask &= self.nips != int(exclude)
+        idx = np.flatnonzero(mask)
+        idx = idx[np.argsort(distances[idx], kind='stable')]
+        return [(int(self.nips[i]), int(distances[i])) for i in idx]
+
+    def duplicates_of(self, nips, max_distance:int = DUPLICATE_DISTANCE) -> dict[int, list[tuple[int, int]]]:
+        """For each of nips that is indexed, the other NIPs with a near-identical photo."""
+        found = {}
+        for nip in nips:
+            value = self.get(nip)
+            if value is None:
+                continue
+            matches = self.query(value, max_distance, exclude=nip)
+            if matches:
+                found[int(nip)] = matches
+        return found
+
+
+def index_folder(folder:Path = Path("images/croped"), index:PhashIndex | None = None) -> PhashIndex:
+    """Hashes every '<nip>.png' crop in folder into index (used to backfill old crops)."""
+    if index is None:
+        index = PhashIndex()
+    nips, values = [], []
+    for crop in Path(folder).glob('*.png'):
+        if crop.stem.isdigit():
+            img = cv2.imread(str(crop), cv2.IMREAD_GRAYSCALE)
+            if img is not None:
+                nips.append(int(crop.stem))
+                values.append(dhash(img))
+    index.add_many(nips, values)
+    return index
+
+
+if __name__ == '__main__':
+    index = index_folder()
+    index.save()
+    print(len(index), 'photos indexed')
+    for nip, matches in index.duplicates_of(index.nips).items():
+        print(nip, 'looks like', ', '.join(f'{other} (distance {d})' for other, d in matches))
@@ -0,0 +1,336 @@
+"""
+Streaming photo normalization: download -> decode/detect/crop -> write.
+
+Downloads and writes are I/O bound and run on threads; decoding, detection and
+cropping run in worker processes that each keep their own detector loaded.
+Stages are joined by bounded queues so a slow stage applies back-pressure
+instead of piling photos up in memory, and the detector always has the next
+batch waiting while the network catches up.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import cv2
+import pandas as pd
+
+from registration import imageparser as im
+from registration.phash import PhashIndex, dhash
+from registration.photostore import PhotoStore
+
+OUTPUT_FOLDER = Path("images/croped")
+OUTPUT_SIZE = (413, 531)
+# Photos are decoded with their longer side no smaller than this (the detector
+# letterboxes to this size anyway)
+DECODE_SIZE = 1080
+_DONE = object()
+
+
+@dataclass
+class StageStats:
+    name: str
+    items: int = 0
+    busy_seconds: float = 0.0
+    started: float = field(default_factory=time.perf_counter)
+
+    def add(self, items:int, seconds:float):
+        self.items += items
+        self.busy_seconds += seconds
+
+    @property
+    def throughput(self) -> float:
+        elapsed = time.perf_counter() - self.started
+        return self.items / elapsed if elapsed else 0.0
+
+
+def _init_worker(detector_name:str, threads:int | None):
+    im.DETECTOR_NAME = detector_name
+    if threads:
+        im.set_torch_threads(threads)
+    # Load the model before the first batch arrives
+    im.get_detector()
+
+
+def _rescale(boxes, factor:int):
+    if boxes is None or factor == 1:
+        return boxes
+    boxes = boxes.copy()
+    boxes[:, :4] *= factor
+    return boxes
+
+
+def _process_batch(items:list[tuple], output_size:tuple[int, int], percent_inc:float,
+                   decode_size:int = DECODE_SIZE):
+    """
+    Decode, detect and crop one batch. Runs inside a worker.
+
+    Items that already carry detections from the photo store skip the detector,
+    and photos that fail the quality gate never reach it. Boxes, stored or
+    returned, are in the coordinates of the full-size photo.
+    """
+    # The gate and detector work on a copy decoded straight at a reduced size
+    # when the photo is much larger than decode_size; the crop is always cut
+    # from the full-resolution photo, like recrop.py does
+    reductions = {item[0]: im.decode_reduction(item[2], decode_size) for item in items}
+    decoded = {item[0]: im.read_image(item[2], reductions[item[0]]) for item in items}
+    rejected = {}
+    for item in items:
+        if item[5] is None:
+            reasons = im.check_quality(decoded[item[0]] if decoded[item[0]] is not None else item[2])
+            if reasons:
+                rejected[item[0]] = ', '.join(reasons)
+    to_detect = [item for item in items if item[5] is None and item[0] not in rejected]
+    if to_detect:
+        all_dets = im.detect_faces_batched([decoded[item[0]] for item in to_detect], im.get_detector(),
+                                           size=decode_size, batch_size=len(to_detect))
+        detected = {item[0]: _rescale(dets, reductions[item[0]]) for item, dets in zip(to_detect, all_dets)}
+    else:
+        detected = {}
+    results = []
+    for position, nip, image, output_image, digest, boxes in items:
+        if position in rejected:
+            print("Rejected image ", image.name, rejected[position])
+            results.append((position, nip, output_image, None, digest, None, rejected[position]))
+            continue
+        if boxes is None:
+            boxes = detected.get(position)
+        reason = None
+        try:
+            full = decoded[position] if reductions[position] == 1 else im.read_image(image)
+            cropped = im.crop_image(full, boxes[0, :4], output_size=output_size, percent_inc=percent_inc)
+        except Exception:
+            print("No faces for image ", image.name)
+            cropped = None
+            reason = 'no face detected'
+        results.append((position, nip, output_image, cropped, digest, boxes, reason))
+    return results
+
+
+class PhotoPipeline:
+    """
+    Normalizes the photos of a DataFrame of registrations.
+
+    Args:
+        detect_workers (int): Processes running the detector. 0 runs detection
+            on a thread in this process, reusing its already loaded detector.
+        batch_size (int): Photos per detector call. Defaults to what fits in
+            free memory, split between the workers.
+        threads (int): torch threads per worker.
+        queue_size (int): Capacity of each queue between stages, in photos.
+        store (PhotoStore): Where raw photos and detections are cached.
+        phashes (PhashIndex): Perceptual hashes of the crops, to spot reused photos.
+        decode_size (int): Larger photos are decoded at 1/2, 1/4 or 1/8 size
+            as long as their longer side stays above this. Also the size the
+            detector letterboxes to.
+
+    The worker pool is kept between runs so detectors stay loaded; call
+    close() when done.
+    """
+    def __init__(self, output_size=OUTPUT_SIZE, output_folder=OUTPUT_FOLDER,
+                 download_workers=im.DOWNLOAD_WORKERS, detect_workers=1,
+                 write_workers=2, batch_size=None, threads=None, queue_size=64,
+                 percent_inc=75, store=None, phashes=None, decode_size=DECODE_SIZE):
+        self.output_size = output_size
+        self.percent_inc = percent_inc
+        self.decode_size = decode_size
+        self.store = store or PhotoStore()
+        self.phashes = phashes if phashes is not None else PhashIndex()
+        self.output_folder = Path(output_folder)
+        self.download_workers = download_workers
+        self.detect_workers = detect_workers
+        self.write_workers = write_workers
+        self.batch_size = batch_size or max(1, im.detection_batch_size(decode_size) // max(detect_workers, 1))
+        self.threads = threads or (max(1, (os.cpu_count() or 1) // detect_workers) if detect_workers else None)
+        self.queue_size = queue_size
+        self._executor: Executor | None = None
+        self.stats: dict[str, StageStats] = {}
+        self._queues: dict[str, queue.Queue] = {}
+        self._in_flight = 0
+        # NIP -> why its photo could not be normalized, for the last run
+        self.rejections: dict = {}
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.detect_workers:
+                self._executor = ProcessPoolExecutor(
+                    self.detect_workers, initializer=_init_worker,
+                    initargs=(im.DETECTOR_NAME, self.threads),
+                )
+            else:
+                if self.threads:
+                    im.set_torch_threads(self.threads)
+                self._executor = ThreadPoolExecutor(1)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def queue_depths(self) -> dict[str, int]:
+        depths = {name: q.qsize() for name, q in self._queues.items()}
+        depths['detect'] = self._in_flight
+        return depths
+
+    def summary(self) -> str:
+        lines = [
+            f'{s.name:<10}{s.items:>6} photos {s.throughput:>7.2f}/s  busy {s.busy_seconds:>7.1f}s'
+            for s in self.stats.values()
+        ]
+        return '\n'.join(lines)
+
+    def _prepare(self, position:int, nip, image:Path | None, url:str, results:list) -> tuple | None:
+        """Stores a downloaded photo and returns its work item, or None if there is nothing to detect."""
+        if image is None:
+            self.rejections[nip] = 'download failed'
+            return None
+        digest = self.store.add(image)
+        self.store.record_source(nip, url, digest)
+        output_image = self.output_folder / image.name.replace(image.suffix, '.png')
+        if output_image.exists() and self.store.crop_is_current(nip, digest, self.output_size, self.percent_inc):
+            print(image.name, 'Already normalized. Skipping...')
+            results[position] = output_image
+            return None
+        print('Normalizing ', image.name)
+        return position, nip, image, output_image, digest, self.store.detections(digest, im.DETECTOR_NAME)
+
+    def _download(self, df:pd.DataFrame, results:list, download_q:queue.Queue):
+        stats = self.stats['download']
+        urls = df['Fotografia'].to_list()
+        seen = set()
+        try:
+            start = time.perf_counter()
+            for position, nip, image in im.iter_downloads(df, workers=self.download_workers):
+                seen.add(position)
+                try:
+                    item = self._prepare(position, nip, image, urls[position], results)
+                except Exception as e:
+                    print('Could not store photo for', nip, e)
+                    self.rejections[nip] = f'unusable photo ({e})'
+                    item = None
+                stats.add(1, time.perf_counter() - start)
+                if item is not None:
+                    download_q.put(item)
+                start = time.perf_counter()
+        except Exception as e:
+            print('Downloads failed:', e)
+            for position, nip in enumerate(df['NIP Unizar']):
+                if position not in seen:
+                    self.rejections.setdefault(nip, 'download failed')
+        finally:
+            # The dispatcher waits for this, so it has to be sent whatever happened
+            download_q.put(_DONE)
+
+    def _save(self, item:tuple, results:list):
+        position, nip, output_image, cropped, digest, boxes, reason = item
+        if reason:
+            self.rejections[nip] = reason
+        if boxes is not None:
+            self.store.record_detections(digest, im.DETECTOR_NAME, boxes)
+        if cropped is not None:
+            if not cv2.imwrite(str(output_image), cropped):
+                raise OSError(f'could not write {output_image}')
+            self.store.record_crop(nip, digest, self.output_size, self.percent_inc)
+            self.phashes.add(nip, dhash(cropped))
+            results[position] = output_image
+
+    def _write(self, results:list, write_q:queue.Queue):
+        stats = self.stats['write']
+        while (item := write_q.get()) is not _DONE:
+            start = time.perf_counter()
+            try:
+                self._save(item, results)
+            except Exception as e:
+                # A writer that dies would leave the detector blocked on a full queue
+                print('Could not save crop for', item[1], e)
+                self.rejections[item[1]] = f'could not save crop ({e})'
+            stats.add(1, time.perf_counter() - start)
+
+    def _dispatch(self, download_q:queue.Queue, write_q:queue.Queue):
+        executor = self._get_executor()
+        stats = self.stats['detect']
+        # Each batch holds a slot until its results are queued for writing
+        n_slots = max(max(self.detect_workers, 1) + 1, self.queue_size // self.batch_size)
+        slots = threading.BoundedSemaphore(n_slots)
+        lock = threading.Lock()
+
+        def submit(batch):
+            slots.acquire()
+            with lock:
+                self._in_flight += len(batch)
+            submitted = time.perf_counter()
+            future = executor.submit(_process_batch, batch, self.output_size, self.percent_inc, self.decode_size)
+
+            def done(f, size=len(batch)):
+                try:
+                    for result in f.result():
+                        write_q.put(result)
+                except Exception as e:
+                    print('Detection batch failed:', e)
+                    for item in batch:
+                        self.rejections[item[1]] = f'detection failed ({e})'
+                with lock:
+                    self._in_flight -= size
+                stats.add(size, time.perf_counter() - submitted)
+                slots.release()
+            future.add_done_callback(done)
+
+        batch = []
+        finished = False
+        while not finished:
+            try:
+                # Don't hold a partial batch back while the network is slow
+                item = download_q.get(timeout=0.5 if batch else None)
+            except queue.Empty:
+                submit(batch)
+                batch = []
+                continue
+            if item is _DONE:
+                finished = True
+            else:
+                batch.append(item)
+            if batch and (finished or len(batch) >= self.batch_size):
+                submit(batch)
+                batch = []
+        # Every slot is back once the last batch's results are queued
+        for _ in range(n_slots):
+            slots.acquire()
+
+    def run(self, df:pd.DataFrame) -> list[Path | None]:
+        """Returns the cropped photo for each row of df, in order (None on failure)."""
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        results: list[Path | None] = [None] * len(df)
+        download_q = queue.Queue(self.queue_size)
+        write_q = queue.Queue(self.queue_size)
+        self._queues = {'download': download_q, 'write': write_q}
+        self.rejections = {}
+        self.stats = {name: StageStats(name) for name in ('download', 'detect', 'write')}
+
+        # A new photo URL for a NIP means a re-submission: fetch it again
+        for nip, url in zip(df['NIP Unizar'], df['Fotografia']):
+            if isinstance(url, str) and url.strip() and self.store.source_changed(nip, url):
+                im.image_path(nip, url).unlink(missing_ok=True)
+
+        downloader = threading.Thread(target=self._download, args=(df, results, download_q), daemon=True)
+        writers = [
+            threading.Thread(target=self._write, args=(results, write_q), daemon=True)
+            for _ in range(self.write_workers)
+        ]
+        downloader.start()
+        for writer in writers:
+            writer.start()
+        try:
+            self._dispatch(download_q, write_q)
+            downloader.join()
+        finally:
+            for _ in writers:
+                write_q.put(_DONE)
+            for writer in writers:
+                writer.join()
+        self.store.save()
+        self.phashes.save()
+        return results
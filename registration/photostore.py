@@ -0,0 +1,103 @@
+"""
+Content-addressed store for registration photos and their face detections.
+
+Raw photos are kept under images/store/raw by the SHA-256 of their bytes, and
+a JSON sidecar index records, per hash, the boxes and scores the detector
+returned. Crops remember which photo and crop parameters they were made from,
+so a re-submitted photo, a new URL or a new output_size is noticed, and the
+detector only ever runs on pixels it has not seen before.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+
+STORE_FOLDER = Path("images/store")
+
+
+def file_hash(path:Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _url_key(url:str) -> str:
+    # The signature query string can change between exports of the same file
+    return str(url).split('?')[0]
+
+
+class PhotoStore:
+    def __init__(self, folder:Path = STORE_FOLDER):
+        self.folder = Path(folder)
+        self.index_file = self.folder / 'index.json'
+        self._lock = threading.Lock()
+        if self.index_file.exists():
+            self.index = json.loads(self.index_file.read_text())
+        else:
+            self.index = {}
+        for section in ('detections', 'crops', 'sources'):
+            self.index.setdefault(section, {})
+
+    def save(self):
+        with self._lock:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            tmp = self.index_file.with_suffix('.json.part')
+            tmp.write_text(json.dumps(self.index))
+            os.replace(tmp, self.index_file)
+
+    def raw_path(self, digest:str, suffix:str = '') -> Path:
+        return self.folder / 'raw' / digest[:2] / (digest + suffix)
+
+    def raw_file(self, digest:str) -> Path | None:
+        """The stored photo for a hash, whatever its extension."""
+        return next(self.raw_path(digest).parent.glob(digest + '*'), None)
+
+    def add(self, photo:Path) -> str:
+        """Stores a copy of photo under its content hash and returns the hash."""
+        digest = file_hash(photo)
+        stored = self.raw_path(digest, photo.suffix.lower())
+        if not stored.exists():
+            stored.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(photo, stored)
+        return digest
+
+    # Where each NIP's photo came from
+    def source_changed(self, nip, url:str) -> bool:
+        source = self.index['sources'].get(str(nip))
+        return source is not None and source['url'] != _url_key(url)
+
+    def record_source(self, nip, url:str, digest:str):
+        with self._lock:
+            self.index['sources'][str(nip)] = {'url': _url_key(url), 'hash': digest}
+
+    # Detector output per photo hash
+    def detections(self, digest:str, detector:str | None = None) -> np.ndarray | None:
+        """Stored boxes for a photo; with detector, only if that model produced them."""
+        entry = self.index['detections'].get(digest)
+        if entry is None or (detector is not None and entry['detector'] != detector):
+            return None
+        return np.array(entry['boxes'], dtype=np.float32).reshape(-1, 5)
+
+    def record_detections(self, digest:str, detector:str, boxes:np.ndarray):
+        with self._lock:
+            self.index['detections'][digest] = {
+                'detector': detector,
+                'boxes': np.asarray(boxes, dtype=float).reshape(-1, 5).round(2).tolist(),
+            }
+
+    # Crops made per NIP
+    def crop_is_current(self, nip, digest:str, output_size, percent_inc) -> bool:
+        crop = self.index['crops'].get(str(nip))
+        return crop == {'hash': digest, 'output_size': list(output_size), 'percent_inc': percent_inc}
+
+    def record_crop(self, nip, digest:str, output_size, percent_inc):
+        with self._lock:
+            self.index['crops'][str(nip)] = {
+                'hash': digest, 'output_size': list(output_size), 'percent_inc': percent_inc,
+            }
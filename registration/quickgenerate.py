@@ -1,11 +1,10 @@
 from registration.cardgenerator.cardgenerator import generate_card, CardOptions
 from registration.cardgenerator.qrshow import show_qr_codes
-import pandas as pd
+from registration.registry import StudentRegistry
 from pathlib import Path
 from uuid import uuid4
 
-db = pd.read_excel('database.xlsx')
-to_generate = db.loc[db['NIP Unizar'] > 900000]
+to_generate = StudentRegistry().to_dataframe('"NIP Unizar" > ?', (900000,))
 
 
 
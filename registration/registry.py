@@ -0,0 +1,196 @@
+"""
+Student registry: the SQLite database every tool reads and writes students
+through. database.xlsx is now only an export of it.
+
+Rows are keyed by 'NIP Unizar' with a unique index on 'uuid', so point lookups
+from the UIs and the card readers don't parse a workbook. Columns follow
+whatever the registration form provides; new ones are added as they appear.
+
+    python -m registration.registry export database.xlsx
+    python -m registration.registry import database.xlsx
+"""
+import argparse
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from registration.excelcache import read_excel_cached
+
+REGISTRY_FILE = Path("registry.sqlite")
+LEGACY_DATABASE = Path("database.xlsx")
+KEY = 'NIP Unizar'
+TABLE = 'students'
+
+
+def _quote(column:str) -> str:
+    return '"' + str(column).replace('"', '""') + '"'
+
+
+def _to_sql_value(value):
+    if pd.api.types.is_scalar(value) and pd.isna(value):  # None, NaN, NaT, pd.NA
+        return None
+    if isinstance(value, Path):
+        return str(value)
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if hasattr(value, 'item'):  # numpy scalars
+        return value.item()
+    return value
+
+
+class StudentRegistry:
+    def __init__(self, path:Path = REGISTRY_FILE, legacy_excel:Path | None = LEGACY_DATABASE):
+        """
+        Opens (or creates) the registry at path. If it is new and legacy_excel
+        exists, the workbook is imported once so existing installs carry on.
+        If that import fails, the new registry is deleted again so the next
+        start retries it instead of opening an empty one.
+        """
+        self.path = Path(path)
+        is_new = not self.path.exists()
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {TABLE} ({_quote(KEY)} INTEGER PRIMARY KEY, uuid TEXT)'
+        )
+        self.conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS students_uuid ON {TABLE} (uuid)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS rejected (row_hash TEXT PRIMARY KEY, reported REAL)')
+        self.conn.commit()
+        if is_new and legacy_excel is not None and Path(legacy_excel).exists():
+            print('Importing', legacy_excel, 'into', self.path)
+            try:
+                self.import_excel(legacy_excel)
+            except BaseException:
+                self.close()
+                for suffix in ('', '-wal', '-shm'):
+                    Path(f'{self.path}{suffix}').unlink(missing_ok=True)
+                raise
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self) -> 'StudentRegistry':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute(f'SELECT COUNT(*) FROM {TABLE}').fetchone()[0]
+
+    def columns(self) -> list[str]:
+        return [row[1] for row in self.conn.execute(f'PRAGMA table_info({TABLE})')]
+
+    def _ensure_columns(self, columns):
+        existing = set(self.columns())
+        for column in columns:
+            if column not in existing:
+                self.conn.execute(f'ALTER TABLE {TABLE} ADD COLUMN {_quote(column)}')
+
+    def upsert(self, df:pd.DataFrame):
+        """Inserts the rows of df, replacing the given columns of NIPs already present."""
+        if df.empty:
+            return
+        df = df[df[KEY].notna()]
+        columns = list(df.columns)
+        names = ', '.join(_quote(c) for c in columns)
+        placeholders = ', '.join('?' for _ in columns)
+        updates = ', '.join(f'{_quote(c)} = excluded.{_quote(c)}' for c in columns if c != KEY)
+        sql = f'INSERT INTO {TABLE} ({names}) VALUES ({placeholders}) ON CONFLICT({_quote(KEY)}) DO '
+        sql += f'UPDATE SET {updates}' if updates else 'NOTHING'
+        rows = [
+            tuple(_to_sql_value(v) for v in row)
+            for row in df.astype(object).itertuples(index=False, name=None)
+        ]
+        with self._lock, self.conn:
+            self._ensure_columns(columns)
+            self.conn.executemany(sql, rows)
+
+    def delete(self, nips):
+        with self._lock, self.conn:
+            self.conn.executemany(f'DELETE FROM {TABLE} WHERE {_quote(KEY)} = ?', [(int(n),) for n in nips])
+
+    def _one(self, column:str, value) -> dict | None:
+        cursor = self.conn.execute(f'SELECT * FROM {TABLE} WHERE {column} = ?', (value,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([d[0] for d in cursor.description], row))
+
+    def get(self, nip) -> dict | None:
+        return self._one(_quote(KEY), int(nip))
+
+    def get_by_uuid(self, uuid) -> dict | None:
+        return self._one('uuid', str(uuid))
+
+    def nips(self) -> set[int]:
+        return {row[0] for row in self.conn.execute(f'SELECT {_quote(KEY)} FROM {TABLE}')}
+
+    def _hashes(self, column:str) -> dict[int, str | None]:
+        if column not in self.columns():
+            return {nip: None for nip in self.nips()}
+        return dict(self.conn.execute(f'SELECT {_quote(KEY)}, {_quote(column)} FROM {TABLE}'))
+
+    def row_hashes(self) -> dict[int, str | None]:
+        """Hash of the form response each student was last synced from (see sheetsync.row_hashes)."""
+        return self._hashes('row_hash')
+
+    def card_hashes(self) -> dict[int, str | None]:
+        """Hash of the printed fields each student was last synced with (see sheetsync.PRINTED_COLUMNS)."""
+        return self._hashes('card_hash')
+
+    def rejected_hashes(self) -> set[str]:
+        """Hashes of the form responses already reported as invalid."""
+        return {row[0] for row in self.conn.execute('SELECT row_hash FROM rejected')}
+
+    def record_rejected(self, hashes):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO rejected VALUES (?, ?)', [(h, time.time()) for h in hashes]
+            )
+
+    def mark_cards_stale(self, nips, stale:bool = True):
+        """Flags the printed cards of nips as out of date with the registry (or clears the flag)."""
+        with self._lock, self.conn:
+            self._ensure_columns(['card_stale'])
+            self.conn.executemany(
+                f'UPDATE {TABLE} SET card_stale = ? WHERE {_quote(KEY)} = ?',
+                [(int(stale), int(n)) for n in nips],
+            )
+
+    def to_dataframe(self, where:str | None = None, params=()) -> pd.DataFrame:
+        """All students (or those matching a SQL where clause) as a DataFrame."""
+        sql = f'SELECT * FROM {TABLE}'
+        if where:
+            sql += f' WHERE {where}'
+        return pd.read_sql_query(sql + f' ORDER BY {_quote(KEY)}', self.conn, params=params)
+
+    def backup(self, path:Path):
+        with sqlite3.connect(path) as target:
+            self.conn.backup(target)
+
+    def import_excel(self, path:Path):
+        self.upsert(read_excel_cached(path))
+
+    def export_excel(self, path:Path = LEGACY_DATABASE):
+        self.to_dataframe().to_excel(path, index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('workbook', type=Path, nargs='?', default=LEGACY_DATABASE)
+    parser.add_argument('--registry', type=Path, default=REGISTRY_FILE)
+    args = parser.parse_args()
+
+    registry = StudentRegistry(args.registry, legacy_excel=None)
+    if args.command == 'export':
+        registry.export_excel(args.workbook)
+        print(len(registry), 'students exported to', args.workbook)
+    else:
+        registry.import_excel(args.workbook)
+        print(len(registry), 'students in', args.registry)
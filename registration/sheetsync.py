@@ -0,0 +1,119 @@
+"""
+Incremental reads of the registration form's response sheet.
+
+Form responses are only ever appended, so instead of fetching A1:H on every
+run we remember the next unread row and fetch A{row}:H. The cursor also keeps
+a fingerprint of the header row; if the columns change, or FULL_SYNC_INTERVAL
+has passed since the last full read, the whole sheet is read again to pick up
+anything edited in place. While rows that failed intake are pending, a full
+read that finds the sheet unchanged still retries them.
+"""
+import hashlib
+import json
+import os
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import pandas as pd
+
+CURSOR_FILE = Path("sync_cursor.json")
+FULL_SYNC_INTERVAL = 24 * 60 * 60  # seconds
+LAST_COLUMN = 'H'
+# Form fields the registry keeps; other columns (new questions, timestamps)
+# don't make a response 'changed'
+SYNCED_COLUMNS = ['Nombre', 'Apellidos', 'NIP Unizar', 'Email', 'Teléfono', 'Fecha de Nacimiento',
+                  'Estudios Matriculados', 'Tratamiento de Datos', 'Fotografia']
+# Fields printed on the card (Fotografia as the photo's URL); only edits to
+# these make a card stale
+PRINTED_COLUMNS = ['Nombre', 'Apellidos', 'NIP Unizar', 'Estudios Matriculados', 'Fotografia']
+
+
+@dataclass
+class SyncCursor:
+    next_row: int = 2  # sheet row number (1-based); row 1 is the header
+    header_hash: str = ''
+    last_full_sync: float = 0.0
+    rows_hash: str = ''  # of all data rows, as of the last full read
+    pending: bool = False  # some valid rows could not be brought in yet
+
+    @classmethod
+    def load(cls, path:Path = CURSOR_FILE) -> 'SyncCursor':
+        if Path(path).exists():
+            return cls(**json.loads(Path(path).read_text()))
+        return cls()
+
+    def save(self, path:Path = CURSOR_FILE):
+        tmp = Path(path).with_suffix('.part')
+        tmp.write_text(json.dumps(asdict(self)))
+        os.replace(tmp, path)
+
+
+def header_fingerprint(header:list[str]) -> str:
+    return hashlib.sha1('\x1f'.join(header).encode()).hexdigest()
+
+
+def rows_fingerprint(rows:list[list]) -> str:
+    return hashlib.sha1(json.dumps(rows).encode()).hexdigest()
+
+
+def row_hashes(df:pd.DataFrame, columns:list[str] = SYNCED_COLUMNS) -> pd.Series:
+    """
+    Content hash of the given columns of each response (those present in df),
+    independent of column order, to spot edited rows.
+    """
+    columns = sorted(c for c in columns if c in df.columns)
+    cells = df[columns].astype('string').fillna('')
+    joined = cells[columns[0]].str.cat([cells[c] for c in columns[1:]], sep='\x1f')
+    return pd.Series([hashlib.sha1(row.encode()).hexdigest() for row in joined], index=df.index, dtype=object)
+
+
+def classify_rows(nips:pd.Series, hashes:pd.Series, known:dict[int, str | None]) -> pd.Series:
+    """
+    'new', 'changed' or 'unchanged' for each row, against the hashes stored per
+    NIP. Rows stored before hashes were kept are 'unhashed'.
+    """
+    stored = nips.map(known)
+    status = pd.Series('changed', index=nips.index, dtype=object)
+    status[stored == hashes] = 'unchanged'
+    status[stored.isna() & nips.isin(list(known))] = 'unhashed'
+    status[~nips.isin(list(known))] = 'new'
+    return status
+
+
+def _get(sheet, sheet_id:str, cell_range:str) -> list[list[str]]:
+    result = sheet.values().get(spreadsheetId=sheet_id, range=cell_range).execute()
+    return result.get("values", [])
+
+
+def fetch_rows(service, sheet_id:str, cursor:SyncCursor, full:bool = False,
+               full_sync_interval:float = FULL_SYNC_INTERVAL) -> tuple[pd.DataFrame, SyncCursor, bool]:
+    """
+    Reads the rows added since cursor.
+
+    Returns the rows as a DataFrame with the sheet's header as columns, the
+    cursor to save once those rows have been committed, and whether this was
+    a full read. The passed cursor is not modified.
+    """
+    sheet = service.spreadsheets()
+    header = (_get(sheet, sheet_id, f'A1:{LAST_COLUMN}1') or [[]])[0]
+    fingerprint = header_fingerprint(header)
+    now = time.time()
+    full = (
+        full
+        or cursor.header_hash != fingerprint
+        or now - cursor.last_full_sync > full_sync_interval
+    )
+    start = 2 if full else cursor.next_row
+    rows = _get(sheet, sheet_id, f'A{start}:{LAST_COLUMN}')
+    # The API drops trailing empty cells, so short rows are padded back out
+    rows = [row + [None] * (len(header) - len(row)) for row in rows]
+    new_cursor = SyncCursor(
+        next_row=start + len(rows),
+        header_hash=fingerprint,
+        last_full_sync=now if full else cursor.last_full_sync,
+        rows_hash=rows_fingerprint(rows) if full else cursor.rows_hash,
+        pending=cursor.pending,
+    )
+    print('Fetched', len(rows), 'rows from', f'A{start}', '(full sync)' if full else '')
+    return pd.DataFrame(rows, columns=header), new_cursor, full
@@ -9,16 +9,18 @@ import subprocess
 from typing import get_type_hints, get_args
 from dataclasses import fields
 import inspect # Re-adding inspect as it can still be useful for other introspection tasks
-import pandas as pd
 from typing import Dict, Any, List, Literal
 from registration.cardgenerator.cardgenerator import generate_card, CardOptions
+from registration.cardgenerator.cardindex import CARD_FOLDER, default_card_index
+from registration.registry import REGISTRY_FILE, StudentRegistry
 
 def load_data(file_path: str) -> (Dict[Any, Dict[str, Any]], List[Any]):
     """
-    Loads data from an Excel file and returns a dictionary mapping NIPs to data
-    and a sorted list of NIPs.
+    Loads the students in the registry and returns a dictionary mapping NIPs to
+    data and a sorted list of NIPs.
     """
-    df = pd.read_excel(file_path)
+    with StudentRegistry(file_path) as registry:
+        df = registry.to_dataframe()
     # Create a mapping for easy lookup
     nip_to_data = {row['NIP Unizar']: row for index, row in df.iterrows()}
     return nip_to_data, sorted(list(nip_to_data.keys()))
@@ -48,12 +50,12 @@ def show_pdf_preview(pdf_path):
 
 # Main application class
 class IDCardViewerApp:
-    def __init__(self, master, data, nips, excel_file):
+    def __init__(self, master, data, nips, registry_file):
         self.master = master
         self.master.title("ID Card Viewer")
         self.data = data
         self.nips = nips
-        self.excel_file = excel_file
+        self.registry_file = registry_file
         self.current_nip_index = 0
         
         # Initialize an instance of CardOptions
@@ -175,7 +177,7 @@ class IDCardViewerApp:
     def update_display(self, nip):
         student_data = self.data[nip]
         uuid = str(student_data['uuid'])
-        pdf_path = Path("output_cards") / f"{nip}.pdf"
+        pdf_path = default_card_index().card_file(nip)
 
         # Update Info Textbox
         self.info_text.config(state="normal")
@@ -190,8 +192,9 @@ class IDCardViewerApp:
         self.qr_label.configure(image=qr_photo)
         self.qr_label.image = qr_photo  # Keep a reference
 
-        # Check if PDF exists
-        if not pdf_path.exists():
+        # Look the card up in the card index
+        # A card made before the student's data was corrected is not shown
+        if pdf_path is None or student_data.get('card_stale') == 1:
             # Show the default template if the card doesn't exist
             template_path = Path("output_cards") / "template.pdf"
             if template_path.exists():
@@ -216,7 +219,7 @@ class IDCardViewerApp:
     def generate_card_and_display(self):
         nip = self.nips[self.current_nip_index]
         row = self.data[nip]
-        pdf_path = Path("output_cards") / f"{nip}.pdf"
+        pdf_path = CARD_FOLDER / f"{nip}.pdf"
 
         # Show a loading screen
         loading_label = tk.Label(self.master, text="Generating ID card...", font=("Arial", 16))
@@ -232,9 +235,14 @@ class IDCardViewerApp:
             str(row['Apellidos']),
             str(row['NIP Unizar']),
             str(row['Estudios Matriculados']),
-            self.card_options # Pass the CardOptions instance
+            self.card_options, # Pass the CardOptions instance
+            card_index=default_card_index(),
         )
 
+        with StudentRegistry(self.registry_file) as registry:
+            registry.mark_cards_stale([nip], stale=False)
+        row['card_stale'] = 0
+
         # Remove loading message and update display with the new card
         loading_label.pack_forget()
         self.update_display(nip)
@@ -248,7 +256,7 @@ class IDCardViewerApp:
         current_nip = self.nip_selector.get()
         
         # Reload data using the instance variable
-        self.data, self.nips = load_data(self.excel_file)
+        self.data, self.nips = load_data(self.registry_file)
         
         # Update the combobox values
         self.nip_selector['values'] = self.nips
@@ -265,8 +273,8 @@ class IDCardViewerApp:
 
     def open_card(self):
         nip = self.nips[self.current_nip_index]
-        pdf_path = Path("output_cards") / f"{nip}.pdf"
-        if pdf_path.exists():
+        pdf_path = default_card_index().card_file(nip)
+        if pdf_path is not None:
             try:
                 if os.name == 'nt':  # Windows
                     os.startfile(str(pdf_path))
@@ -281,8 +289,8 @@ class IDCardViewerApp:
 
     def print_card(self):
         nip = self.nips[self.current_nip_index]
-        pdf_path = Path("output_cards") / f"{nip}.pdf"
-        if pdf_path.exists():
+        pdf_path = default_card_index().card_file(nip)
+        if pdf_path is not None:
             try:
                 if os.name == 'nt':  # Windows
                     subprocess.run(['cmd', '/c', 'start', '/b', 'print', str(pdf_path)], check=True)
@@ -312,9 +320,9 @@ class IDCardViewerApp:
 
 # Example usage
 if __name__ == "__main__":
-    excel_file = 'database.xlsx'
-    nip_data, nips = load_data(excel_file)
+    registry_file = str(REGISTRY_FILE)
+    nip_data, nips = load_data(registry_file)
     
     root = tk.Tk()
-    app = IDCardViewerApp(root, nip_data, nips, excel_file)
+    app = IDCardViewerApp(root, nip_data, nips, registry_file)
     root.mainloop()
\ No newline at end of file
@@ -8,6 +8,8 @@ from .card_options_widget import CardOptionsWidget
 from .action_buttons_widget import ActionButtonsWidget
 from .utils import show_qr, show_pdf_preview, load_data, generate_card
 from registration.cardgenerator.cardgenerator import CardOptions
+from registration.cardgenerator.cardindex import CARD_FOLDER, default_card_index
+from registration.registry import REGISTRY_FILE, StudentRegistry
 from pathlib import Path
 from typing import Dict, Any
 from PyQt6.QtGui import QPixmap
@@ -22,8 +24,8 @@ class IDCardViewerMainWindow(QMainWindow):
         self.setWindowTitle("ID Card Viewer")
         self.setGeometry(100, 100, 800, 600) # Initial window size
 
-        self.excel_file = 'database.xlsx'
-        self.data, self.nips = load_data(self.excel_file)
+        self.registry_file = str(REGISTRY_FILE)
+        self.data, self.nips = load_data(self.registry_file)
         self.current_nip_index = 0
         self.card_options = CardOptions()
 
@@ -89,14 +91,14 @@ class IDCardViewerMainWindow(QMainWindow):
         self.student_info_widget.update_student_data(student_data)
 
         uuid = str(student_data['uuid'])
-        pdf_path = Path("output_cards") / f"{nip}.pdf"
+        pdf_path = default_card_index().card_file(nip)
 
         # Update QR Code
         qr_image = show_qr(uuid)
         self.display_widget.set_qr_code_image(qr_image)
 
-        # Update PDF Preview
-        if not pdf_path.exists():
+        # Update PDF Preview (a card made before the student's data was corrected is not shown)
+        if pdf_path is None or student_data.get('card_stale') == 1:
             template_path = Path("output_cards") / "template.pdf"
             if template_path.exists():
                 pdf_image = show_pdf_preview(str(template_path))
@@ -119,7 +121,20 @@ class IDCardViewerMainWindow(QMainWindow):
         QApplication.processEvents() # Process events to show the dialog immediately
 
         try:
-            generate_card(student_data, self.card_options)
+            generate_card(
+                str(CARD_FOLDER / f"{current_nip}.pdf"),
+                student_data['Fotografia'],
+                student_data['uuid'],
+                str(student_data['Nombre']),
+                str(student_data['Apellidos']),
+                str(student_data['NIP Unizar']),
+                str(student_data['Estudios Matriculados']),
+                self.card_options,
+                card_index=default_card_index(),
+            )
+            with StudentRegistry(self.registry_file) as registry:
+                registry.mark_cards_stale([current_nip], stale=False)
+            student_data['card_stale'] = 0
             self.update_display(current_nip)
             print(f"Generated card for NIP: {current_nip}")
         except Exception as e:
@@ -133,7 +148,7 @@ class IDCardViewerMainWindow(QMainWindow):
         print(f"Reloaded card display for NIP: {current_nip}")
 
     def reload_database(self):
-        self.data, self.nips = load_data(self.excel_file)
+        self.data, self.nips = load_data(self.registry_file)
         self.nip_selector_widget.set_nips(self.nips)
         if self.nips:
             self.current_nip_index = 0
@@ -144,8 +159,8 @@ class IDCardViewerMainWindow(QMainWindow):
 
     def open_card(self):
         current_nip = self.nips[self.current_nip_index]
-        pdf_path = Path("output_cards") / f"{current_nip}.pdf"
-        if pdf_path.exists():
+        pdf_path = default_card_index().card_file(current_nip)
+        if pdf_path is not None:
             try:
                 if os.name == 'nt': # For Windows
                     os.startfile(str(pdf_path))
@@ -161,8 +176,8 @@ class IDCardViewerMainWindow(QMainWindow):
 
     def print_card(self):
         current_nip = self.nips[self.current_nip_index]
-        pdf_path = Path("output_cards") / f"{current_nip}.pdf"
-        if pdf_path.exists():
+        pdf_path = default_card_index().card_file(current_nip)
+        if pdf_path is not None:
             try:
                 # This is a placeholder. Actual printing would involve a more robust solution
                 # like QPrintDialog or an external command with specific printer arguments.
@@ -1,7 +1,6 @@
 import qrcode
 import io
 from pathlib import Path
-import pandas as pd
 from typing import Dict, Any, List, Literal
 
 from PyQt6.QtGui import QPixmap, QImage
@@ -9,13 +8,15 @@ from PyQt6.QtCore import QBuffer, QIODevice
 from PIL import Image as PILImage
 import fitz # For PDF preview
 from registration.cardgenerator.cardgenerator import generate_card, CardOptions
+from registration.registry import StudentRegistry
 
 def load_data(file_path: str) -> tuple[Dict[Any, Dict[str, Any]], List[Any]]:
     """
-    Loads data from an Excel file and returns a dictionary mapping NIPs to data
-    and a sorted list of NIPs.
+    Loads the students in the registry and returns a dictionary mapping NIPs to
+    data and a sorted list of NIPs.
     """
-    df = pd.read_excel(file_path)
+    with StudentRegistry(file_path) as registry:
+        df = registry.to_dataframe()
     # Create a mapping for easy lookup
     nip_to_data = {row['NIP Unizar']: row for index, row in df.iterrows()}
     return nip_to_data, sorted(list(nip_to_data.keys()))
@@ -0,0 +1,121 @@
+"""
+Validation and normalization of form responses before any photo is fetched.
+
+NORMALIZERS clean each column in place and RULES say what a valid value looks
+like; both work on whole columns at once, so a full-sheet reconcile costs a
+handful of vectorized string operations. validate() splits the responses into
+valid rows and rejected rows, the latter with a 'Motivo' listing every rule
+they broke.
+"""
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+REASON_COLUMN = 'Motivo'
+# "Acepto", "He leído y acepto…", "Sí", "x"; but not "No acepto" or "No"
+CONSENT = r'acept|^(?:s[ií]|yes|true|x)(?:\W|$)'
+DISSENT = r'^(?:no|false)\b|\bno\s+(?:lo\s+)?acept'
+
+
+def _text(s:pd.Series) -> pd.Series:
+    return s.astype('string').str.strip().str.replace(r'\s+', ' ', regex=True)
+
+
+def _name(s:pd.Series) -> pd.Series:
+    return _text(s).str.title()
+
+
+def _nip(s:pd.Series) -> pd.Series:
+    # Numbers read back from the sheet can come as '123456.0'
+    return _text(s).str.replace(r'\.0$', '', regex=True)
+
+
+def _phone(s:pd.Series) -> pd.Series:
+    s = _text(s).str.replace(r'[\s\-\.\(\)]', '', regex=True)
+    return s.str.replace(r'^(\+34|0034)(?=\d{9}$)', '', regex=True)
+
+
+def _email(s:pd.Series) -> pd.Series:
+    return _text(s).str.lower()
+
+
+def _date(s:pd.Series) -> pd.Series:
+    s = _text(s)
+    parsed = pd.to_datetime(s, format='%d/%m/%Y', errors='coerce')
+    # Only the few values not in the form's own format go through the slow parser
+    other = parsed.isna() & s.notna()
+    if other.any():
+        parsed.loc[other] = pd.to_datetime(s[other], dayfirst=True, errors='coerce', format='mixed').to_numpy()
+    return parsed.dt.strftime('%d/%m/%Y').astype('string')
+
+
+NORMALIZERS = {
+    'Nombre': _name,
+    'Apellidos': _name,
+    'NIP Unizar': _nip,
+    'Teléfono': _phone,
+    'Email': _email,
+    'Fecha de Nacimiento': _date,
+}
+
+
+def _consent(s:pd.Series) -> pd.Series:
+    s = _text(s).str.lower()
+    return s.str.contains(CONSENT) & ~s.str.contains(DISSENT)
+
+
+def _matches(pattern:str):
+    return lambda s: s.str.fullmatch(pattern)
+
+
+def _plausible_birth_date(s:pd.Series) -> pd.Series:
+    year = pd.to_datetime(s, format='%d/%m/%Y', errors='coerce').dt.year
+    return year.between(1900, datetime.now().year - 14)
+
+
+# (column, reason, check); check gets the normalized column and returns a
+# boolean Series that is True where the value is valid
+RULES = [
+    ('NIP Unizar', 'NIP must have 6 digits', _matches(r'\d{6}')),
+    ('Nombre', 'Missing name', lambda s: s.str.len() > 0),
+    ('Apellidos', 'Missing surname', lambda s: s.str.len() > 0),
+    ('Email', 'Invalid email', _matches(r'[^@\s]+@[^@\s]+\.[^@\s]+')),
+    ('Teléfono', 'Invalid phone number', _matches(r'\+?\d{9,15}')),
+    ('Fecha de Nacimiento', 'Invalid birth date', _plausible_birth_date),
+    ('Tratamiento de Datos', 'Data processing consent not given', _consent),
+    ('Fotografia', 'Missing or invalid photo URL', lambda s: _text(s).str.fullmatch(r'https?://\S+')),
+]
+
+
+def normalize(df:pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    for column, normalizer in NORMALIZERS.items():
+        if column in df.columns:
+            df[column] = normalizer(df[column])
+    return df
+
+
+def validate(df:pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Normalizes df and checks it against RULES.
+
+    Returns the valid rows (with 'NIP Unizar' as an integer) and the rejected
+    rows with a REASON_COLUMN explaining why, e.g. 'Invalid email; Invalid
+    phone number'. Rules whose column is not in df are skipped.
+    """
+    df = normalize(df)
+    reasons = np.full(len(df), '', dtype=object)
+    for column, reason, check in RULES:
+        if column not in df.columns:
+            print('Skipping validation of missing column', repr(column))
+            continue
+        valid = check(df[column]).fillna(False).to_numpy(dtype=bool)
+        reasons = np.where(valid, reasons, reasons + reason + '; ')
+    rejected = reasons != ''
+    bad = df[rejected].copy()
+    bad[REASON_COLUMN] = pd.Series(reasons[rejected], index=bad.index, dtype=object).str.rstrip('; ')
+    good = df[~rejected].copy()
+    if 'NIP Unizar' in good.columns:
+        good['NIP Unizar'] = good['NIP Unizar'].astype(int)
+    return good, bad
@@ -1,101 +1,164 @@
 from pathlib import Path
-import shutil
 from registration.sheets_connector import create_sheets_service
-from registration import imageparser as im
+from registration.backups import BackupStore
+from registration.intake import IntakeLog, run_intake
+from registration.photopipeline import PhotoPipeline
+from registration.registry import StudentRegistry
+from registration.sheetsync import CURSOR_FILE, SyncCursor, classify_rows, fetch_rows, row_hashes
+from registration.validation import validate
 import pandas as pd
-import face_detection
-import cv2
-import uuid
-from datetime import datetime
+import argparse
+import time
 
 
-DETECTOR = face_detection.build_detector(
-        "DSFDDetector",
-        max_resolution=1080,
-        confidence_threshold=.5, 
-        nms_iou_threshold=.3
-    )
+def sheets_watcher(service, sheet_id, registry:StudentRegistry, cursor_file:Path = CURSOR_FILE, full:bool = False,
+                   pipeline:PhotoPipeline | None = None, backups:BackupStore | None = None) -> bool:
+    """
+    Syncs form responses into the registry: new NIPs are added and responses
+    edited since they were synced are re-processed, marking their cards stale
+    if a printed field or the photo changed. Returns False if there was
+    nothing to do.
+    """
 
-
-def sheets_watcher(service, sheet_id, database):
-
-    # Call the Sheets API
-    sheet = service.spreadsheets()
-    result = (
-        sheet.values()
-        .get(spreadsheetId=sheet_id, range='A1:H')
-        .execute()
-    )
-    values = result.get("values", [])
+    # Call the Sheets API, reading only the rows past the saved cursor
+    cursor = SyncCursor.load(cursor_file)
+    df, new_cursor, full = fetch_rows(service, sheet_id, cursor, full=full or not len(registry))
     print('Got sheet response')
-    df = pd.DataFrame(values[1:], columns = values[0])
-    df['NIP Unizar'] = pd.to_numeric(df['NIP Unizar'], downcast='integer', errors='coerce')
-    if not database.exists():
-        print('No db found. creating one...')
-        db = pd.DataFrame([], columns = values[0] + ['uuid'])
+    if df.empty and not full:
+        print('No new responses.')
+        return False
+    # Rows that failed last time are retried even if the sheet didn't change
+    if full and len(registry) and not cursor.pending and new_cursor.next_row == cursor.next_row \
+            and new_cursor.rows_hash == cursor.rows_hash:
+        print('Sheet unchanged since the last full sync.')
+        new_cursor.save(cursor_file)
+        return False
+    if not len(registry):
+        print('Registry is empty. filling it...')
     else:
-        shutil.copy(database, f'database_{datetime.today().strftime("%d%m%Y%H%M")}.xlsx.backup')
-        db = pd.read_excel(database, header=0)
-    new_nips = set(df['NIP Unizar'].to_list()) - set(db['NIP Unizar'].to_list())
+        # Only what changed since the last run is written
+        backup = (backups if backups is not None else BackupStore()).snapshot(registry.to_dataframe())
+        if backup:
+            print('Backed up registry:', backup['file'])
+    # Hash the responses as the form sent them, so edits made in place are noticed
+    df['row_hash'] = row_hashes(df)
+    known = registry.row_hashes()
+    # Reject malformed responses before spending any time on their photos
+    df, invalid = validate(df)
+    df = df.drop_duplicates('NIP Unizar', keep='last')  # a re-submission replaces the earlier one
+    # Invalid responses are reported once, until they are edited
+    invalid_status = classify_rows(pd.to_numeric(invalid['NIP Unizar'], errors='coerce'), invalid['row_hash'], known)
+    invalid = invalid[invalid_status.isin(['new', 'changed']) & ~invalid['row_hash'].isin(registry.rejected_hashes())]
+    if len(invalid):
+        print(len(invalid), 'responses rejected by validation')
+    status = classify_rows(df['NIP Unizar'], df['row_hash'], known)
+    # Students synced before hashes were kept just adopt the current one
+    registry.upsert(df.loc[status == 'unhashed', ['NIP Unizar', 'row_hash']])
+    new_nips = set(df.loc[status == 'new', 'NIP Unizar'].to_list())
+    changed_nips = set(df.loc[status == 'changed', 'NIP Unizar'].to_list())
     print('Found the following new NIPs:', new_nips)
-    if new_nips:
-        new_rows = df[df['NIP Unizar'].isin(new_nips)].copy()  # pyright: ignore[reportArgumentType]
-        new_rows = normalize_image(new_rows)  # pyright: ignore[reportArgumentType]
-        new_rows = validate_and_normalize_data(new_rows)
-        new_rows = assign_uuid(new_rows)
-        db = pd.concat([db, new_rows[~(new_rows.isnull().any(axis=1))]])
-    new_rows[(new_rows.isnull().any(axis=1))].to_excel('nulls.xlsx', index=False)
-    db.to_excel(database, index=False)
-    
-def validate_and_normalize_data(df:pd.DataFrame)->pd.DataFrame:
-    # "Nombre","Apellidos","Fecha de Nacimiento",
-    # "Teléfono","Email","NIP Unizar","Estudios Matriculados",
-    # "Fotografia","Tratamiento de Datos"
-    df['Nombre'] = df['Nombre'].str.title()
-    df['Apellidos'] = df['Apellidos'].str.title()
-    #df.loc[df['Apellidos'].str.split().str.len() < 2, 'Apellidos'] = None
-    #df[df['Fecha de Nacimiento']]
-    #TODO: Recast to str?
-    #df.loc[~(df['NIP Unizar'].str.len() == 6), 'NIP Unizar'] = None #FIXME
-    return df
+    print('Found the following changed NIPs:', changed_nips)
+    nulls = pd.DataFrame()
+    duplicates = {}
+    if new_nips or changed_nips:
+        rows = df[df['NIP Unizar'].isin(new_nips | changed_nips)]  # pyright: ignore[reportArgumentType]
+        # Committed batch by batch; a crash only costs the rows not yet committed
+        run_pipeline = pipeline or PhotoPipeline(output_size=(413,531))
+        try:
+            nulls = run_intake(rows, new_nips, registry, lambda batch: normalize_image(batch, run_pipeline))
+            duplicates = nulls.attrs.get('photo_duplicates', {})
+        finally:
+            if pipeline is None:
+                run_pipeline.close()
+    if new_nips or changed_nips or len(invalid):
+        write_report(pd.concat([invalid.drop(columns='row_hash'), nulls]), duplicates)
+        registry.record_rejected(invalid['row_hash'])
+    # A full read retried every earlier failure; an incremental one only its own rows
+    new_cursor.pending = bool(len(nulls)) or (cursor.pending and not full)
+    # Only move past these rows once they are safely in the registry
+    new_cursor.save(cursor_file)
+    IntakeLog(registry).clear_committed()
+    return True
 
-def normalize_image(df:pd.DataFrame)->pd.DataFrame:
-    files = im.download_images(df)
-    output_size = (413,531)
-    output_files = []
-    for image in files:
-        output_image = Path("images/croped") / image.name.replace(image.suffix, '.png')
-        if output_image.exists():
-            print(image.name, 'Already normalized. Skipping...')
-            output_files.append(output_image)
-        else:
-            print('Normalizing ', image.name)
-            try:
-                dets = im.detect_face(image, detector=DETECTOR)
-                face = dets[0, :]
-                cropped = im.crop_image(image, face, output_size=output_size)
-            except:
-                print("No faces for image ", image.name)
-                output_files.append(None)
-            else:
-                cv2.imwrite(output_image , cropped)
-                output_files.append(output_image)
-    df['Fotografia'] = output_files
-    return df
 
-def assign_uuid(df:pd.DataFrame):
-    df['uuid'] = [str(uuid.uuid4()) for i in range(0,len(df))]
+def write_report(rejected:pd.DataFrame, duplicates:dict, report:Path = Path('nulls.xlsx')):
+    """
+    Writes the rows that were not brought in and, on a second 'Duplicados'
+    sheet, the students whose photo looks like someone else's.
+    """
+    with pd.ExcelWriter(report) as writer:
+        rejected.to_excel(writer, sheet_name='Rechazados', index=False)
+        if duplicates:
+            pd.DataFrame(
+                [(nip, other, distance) for nip, matches in duplicates.items() for other, distance in matches],
+                columns=['NIP Unizar', 'Parecida a', 'Distancia'],
+            ).to_excel(writer, sheet_name='Duplicados', index=False)
+
+
+def watch(service, sheet_id, registry:StudentRegistry, min_interval:float = 30, max_interval:float = 600,
+          backoff:float = 2.0):
+    """
+    Keeps syncing until interrupted.
+
+    Polls every min_interval seconds while responses keep arriving and backs
+    off towards max_interval while the sheet is quiet or the API is failing.
+    One Sheets service and one photo pipeline (with its detector loaded) are
+    reused for every pass.
+    """
+    pipeline = PhotoPipeline(output_size=(413,531))
+    backups = BackupStore()
+    interval = min_interval
+    try:
+        while True:
+            try:
+                changed = sheets_watcher(service, sheet_id, registry, pipeline=pipeline, backups=backups)
+            except Exception as e:
+                print('Sync failed:', e)
+                changed = False
+            interval = min_interval if changed else min(max_interval, interval * backoff)
+            print(f'Next check in {interval:.0f}s')
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print('Stopping watcher.')
+    finally:
+        pipeline.close()
+    
+def normalize_image(df:pd.DataFrame, pipeline:PhotoPipeline | None = None)->pd.DataFrame:
+    own_pipeline = pipeline is None
+    pipeline = pipeline or PhotoPipeline(output_size=(413,531))
+    try:
+        df['Fotografia'] = pipeline.run(df)
+        df.attrs['photo_rejections'] = dict(pipeline.rejections)
+        df.attrs['photo_duplicates'] = pipeline.phashes.duplicates_of(df['NIP Unizar'].dropna())
+        for nip, matches in df.attrs['photo_duplicates'].items():
+            print('WARNING: photo of', nip, 'looks like the photo of',
+                  ', '.join(f'{other} (distance {d})' for other, d in matches))
+    finally:
+        if own_pipeline:
+            pipeline.close()
+    print(pipeline.summary())
     return df
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--daemon', action='store_true', help='Keep polling the sheet for new responses')
+    parser.add_argument('--full', action='store_true', help='Re-read the whole sheet')
+    parser.add_argument('--min-interval', type=float, default=30)
+    parser.add_argument('--max-interval', type=float, default=600)
+    parser.add_argument('--export', type=Path, help='Also write the registry to this workbook (e.g. database.xlsx)')
+    args = parser.parse_args()
     credentials = Path(r"credentials.json")
     token = Path(r"token.json")
     sheet_id = '1neWaw0rKhIBjZbc8ZmsJwFyf2vMVpeN6ifqYwcKGS1U'
-    database = Path(r"database.xlsx")
+    registry = StudentRegistry()
     print("Creating service...")
     service = create_sheets_service(credentials, token)
     if not service:
         raise Exception("No service Created!")
+    elif args.daemon:
+        watch(service, sheet_id, registry, args.min_interval, args.max_interval)
     else:
-        sheets_watcher(service, sheet_id, database)
\ No newline at end of file
+        sheets_watcher(service, sheet_id, registry, full=args.full)
+    if args.export:
+        registry.export_excel(args.export)
\ No newline at end of file
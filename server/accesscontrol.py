@@ -15,9 +15,12 @@ from smartcard.CardConnection import CardConnection
 import pandas as pd
 from typing import Dict, Any, List
 import datetime
+from registration.cardgenerator.cardindex import default_card_index
+from registration.excelcache import read_excel_cached, to_excel_cached
+from registration.registry import REGISTRY_FILE, StudentRegistry
 
 # --- Ingress Logic from PostgreSQL Function ---
-def ingress_logic(uuid: str, action: int, df_ingress: pd.DataFrame, df_student_data: pd.DataFrame) -> Dict[str, Any]:
+def ingress_logic(uuid: str, action: int, df_ingress: pd.DataFrame, students: StudentRegistry) -> Dict[str, Any]:
     """
     Translates the PostgreSQL ingress function logic into Python.
 
@@ -25,14 +28,13 @@ def ingress_logic(uuid: str, action: int, df_ingress: pd.DataFrame, df_student_d
         uuid (str): The unique ID of the card.
         action (int): 1 for entry, 0 for exit.
         df_ingress (pd.DataFrame): DataFrame loaded from INGRESS.xlsx.
-        df_student_data (pd.DataFrame): DataFrame loaded from database.xlsx.
+        students (StudentRegistry): The student registry.
 
     Returns:
         Dict[str, Any]: A dictionary with the result of the access control check.
     """
     # Fetch student data for display regardless of access result
-    student_data = df_student_data[df_student_data['uuid'] == uuid]
-    student_data_dict = student_data.iloc[0].to_dict() if not student_data.empty else None
+    student_data_dict = students.get_by_uuid(uuid) if uuid else None
 
     # Rule 0: Check input and if user exists
     if not uuid or action is None:
@@ -65,7 +67,7 @@ def ingress_logic(uuid: str, action: int, df_ingress: pd.DataFrame, df_student_d
     df_ingress.loc[ingress_user_data.index, 'last_change'] = datetime.datetime.now()
     
     # Save the updated DataFrame back to the Excel file
-    df_ingress.to_excel('INGRESS.xlsx', index=False)
+    to_excel_cached(df_ingress, 'INGRESS.xlsx')
 
     return {'result': 'OK', 'message': 'OK', 'student_data': student_data_dict}
 
@@ -173,7 +175,7 @@ class AccessControlApp(tk.Tk):
         self.ingress_file = ingress_file
         self.student_data_file = student_data_file
         self.df_ingress = self.load_data(self.ingress_file)
-        self.df_student_data = self.load_data(self.student_data_file)
+        self.registry = StudentRegistry(student_data_file)
         
         # State variables
         self.mode = tk.StringVar(value='entry')
@@ -191,10 +193,10 @@ class AccessControlApp(tk.Tk):
 
     def load_data(self, file_path):
         """
-        Loads data from an Excel file.
+        Loads data from an Excel file (through its Parquet snapshot).
         """
         try:
-            df = pd.read_excel(file_path)
+            df = read_excel_cached(file_path)
             # Ensure required columns for INGRESS.xlsx exist
             if 'INGRESS' in file_path and ('uuid' not in df.columns or 'status' not in df.columns or 'last_change' not in df.columns):
                  raise ValueError("Required columns 'uuid', 'status', 'last_change' not found in INGRESS.xlsx.")
@@ -205,11 +207,8 @@ class AccessControlApp(tk.Tk):
         except FileNotFoundError:
             print(f"Error: The file '{file_path}' was not found. Please create it.")
             # Create a dummy file if it doesn't exist to prevent errors
-            if 'INGRESS' in file_path:
-                dummy_df = pd.DataFrame({'uuid': [], 'status': [], 'last_change': []})
-            else:
-                dummy_df = pd.DataFrame({'NIP Unizar': [], 'uuid': [], 'Nombre': [], 'Apellidos': [], 'Estudios Matriculados': [], 'Fotografia': []})
-            dummy_df.to_excel(file_path, index=False)
+            dummy_df = pd.DataFrame({'uuid': [], 'status': [], 'last_change': []})
+            to_excel_cached(dummy_df, file_path)
             return dummy_df
             
     def create_widgets(self):
@@ -240,7 +239,7 @@ class AccessControlApp(tk.Tk):
     def on_card_read(self, uuid: str):
         """Callback to handle a successful card read."""
         action = 1 if self.mode.get() == 'entry' else 0
-        response = ingress_logic(uuid, action, self.df_ingress, self.df_student_data)
+        response = ingress_logic(uuid, action, self.df_ingress, self.registry)
         
         result = response['result']
         message = response['message']
@@ -278,8 +277,8 @@ class AccessControlApp(tk.Tk):
             # Update PDF preview
             nip = student_data.get('NIP Unizar')
             if nip:
-                pdf_path = Path("output_cards") / f"{nip}.pdf"
-                if pdf_path.exists():
+                pdf_path = default_card_index().card_file(nip)
+                if pdf_path is not None:
                     pdf_image = show_pdf_preview(str(pdf_path))
                     if pdf_image:
                         pdf_photo = ImageTk.PhotoImage(pdf_image)
@@ -357,8 +356,8 @@ if __name__ == "__main__":
         df_ingress = pd.DataFrame(mock_data_ingress)
         df_ingress.to_excel('INGRESS.xlsx', index=False)
     
-    if not os.path.exists('database.xlsx'):
-        print("Creating mock database.xlsx for demonstration...")
+    if not os.path.exists(REGISTRY_FILE):
+        print("Creating mock registry for demonstration...")
         mock_data_students = {
             'NIP Unizar': [123456, 789012],
             'uuid': ['76d452ab-89ca-4d0a-a2d1-2ffa9ab61117', 'another-uuid-for-testing'],
@@ -368,7 +367,7 @@ if __name__ == "__main__":
             'Fotografia': ['path/to/photo1.jpg', 'path/to/photo2.jpg']
         }
         df_students = pd.DataFrame(mock_data_students)
-        df_students.to_excel('database.xlsx', index=False)
+        StudentRegistry(REGISTRY_FILE).upsert(df_students)
 
-    app = AccessControlApp('INGRESS.xlsx', 'database.xlsx')
+    app = AccessControlApp('INGRESS.xlsx', str(REGISTRY_FILE))
     app.mainloop()
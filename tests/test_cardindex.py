@@ -0,0 +1,29 @@
+"""
+Card lookups through the card index.
+
+    python -m pytest tests
+"""
+import uuid
+
+from registration.cardgenerator.cardindex import CardIndex
+
+
+def test_card_file(tmp_path):
+    folder = tmp_path / 'output_cards'
+    folder.mkdir()
+    index = CardIndex(tmp_path / 'registry.sqlite')
+    card = folder / 'card_123456.pdf'
+    card.write_bytes(b'%PDF')
+    index.record(card, 123456, uuid.uuid4(), 1)
+    assert index.card_file(123456, folder) == card
+
+    # An entry whose file is gone falls back to the old '<nip>.pdf' name
+    card.unlink()
+    assert index.card_file(123456, folder) is None
+    (folder / '123456.pdf').write_bytes(b'%PDF')
+    assert index.card_file(123456, folder) == folder / '123456.pdf'
+
+    # Cards from before the index are found by name as well
+    (folder / '654321.pdf').write_bytes(b'%PDF')
+    assert index.card_file(654321, folder) == folder / '654321.pdf'
+    assert index.card_file(111111, folder) is None
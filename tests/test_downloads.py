@@ -0,0 +1,142 @@
+"""
+Photo downloads against a local HTTP server standing in for Google Drive.
+
+    python -m pytest tests
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+import requests as req
+
+from registration import imageparser as im
+
+PHOTO = b'\xff\xd8' + bytes(range(256)) * 40
+
+
+class StandIn(BaseHTTPRequestHandler):
+    # path -> list of (status, body, headers) served in turn; the last one repeats
+    routes: dict[str, list[tuple]] = {}
+    hits: dict[str, int] = {}
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        responses = self.routes.get(path, [(404, b'', {})])
+        hit = self.hits.get(path, 0)
+        self.hits[path] = hit + 1
+        status, body, headers = responses[min(hit, len(responses) - 1)]
+        if status is None:  # hang up without answering
+            self.close_connection = True
+            return
+        self.send_response(status)
+        headers = {'Content-Length': str(len(body)), **headers}
+        for name, value in headers.items():
+            if value is not None:
+                self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    StandIn.routes, StandIn.hits = {}, {}
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def session():
+    with im.create_session(pool_size=2, retries=2, backoff=0) as session:
+        yield session
+
+
+def test_retries_5xx(server, session, tmp_path):
+    StandIn.routes['/photo.jpg'] = [(503, b'', {}), (502, b'', {}), (200, PHOTO, {})]
+    output = im.download_image(server + '/photo.jpg', tmp_path / '123456.jpg', session, backoff=0)
+    assert output.read_bytes() == PHOTO
+    assert StandIn.hits['/photo.jpg'] == 3
+
+
+def test_gives_up_after_retries(server, session, tmp_path):
+    StandIn.routes['/photo.jpg'] = [(500, b'', {})]
+    with pytest.raises(req.exceptions.RetryError):
+        im.download_image(server + '/photo.jpg', tmp_path / '123456.jpg', session, backoff=0)
+    assert StandIn.hits['/photo.jpg'] == 3
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_dropped_connections_retried_once_per_attempt(server, session, tmp_path):
+    # Only the adapter retries connection errors, so attempts don't multiply
+    StandIn.routes['/photo.jpg'] = [(None, b'', {})]
+    with pytest.raises(req.exceptions.ConnectionError):
+        im.download_image(server + '/photo.jpg', tmp_path / '123456.jpg', session, backoff=0)
+    assert StandIn.hits['/photo.jpg'] == 3
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_size_cap_from_content_length(server, session, tmp_path):
+    StandIn.routes['/big.jpg'] = [(200, PHOTO, {})]
+    with pytest.raises(ValueError, match='larger than'):
+        im.download_image(server + '/big.jpg', tmp_path / '123456.jpg', session, max_bytes=1000)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_size_cap_while_streaming(server, session, tmp_path):
+    # No Content-Length: the cap has to be enforced on the bytes received
+    StandIn.routes['/big.jpg'] = [(200, PHOTO, {'Content-Length': None})]
+    with pytest.raises(ValueError, match='larger than'):
+        im.download_image(server + '/big.jpg', tmp_path / '123456.jpg', session, max_bytes=1000)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_truncated_body_leaves_no_part_file(server, session, tmp_path):
+    StandIn.routes['/cut.jpg'] = [(200, PHOTO[:100], {'Content-Length': str(len(PHOTO))})]
+    with pytest.raises(req.exceptions.ChunkedEncodingError):
+        im.download_image(server + '/cut.jpg', tmp_path / '123456.jpg', session, retries=1, backoff=0)
+    assert StandIn.hits['/cut.jpg'] == 2
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_rename_is_atomic(server, session, tmp_path):
+    output = tmp_path / '123456.jpg'
+    output.write_bytes(b'previous photo')
+    StandIn.routes['/cut.jpg'] = [(200, PHOTO[:100], {'Content-Length': str(len(PHOTO))})]
+    with pytest.raises(req.exceptions.ChunkedEncodingError):
+        im.download_image(server + '/cut.jpg', output, session, retries=0)
+    # A failed download never replaces the photo already in place
+    assert output.read_bytes() == b'previous photo'
+
+    StandIn.routes['/photo.jpg'] = [(200, PHOTO, {})]
+    im.download_image(server + '/photo.jpg', output, session)
+    assert output.read_bytes() == PHOTO
+    assert [p.name for p in tmp_path.iterdir()] == ['123456.jpg']
+
+
+def test_iter_downloads(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    StandIn.routes['/a.jpg'] = [(200, PHOTO, {})]
+    StandIn.routes['/b.jpg'] = [(404, b'', {})]
+    df = pd.DataFrame({
+        'NIP Unizar': [111111, 222222],
+        'Fotografia': [server + '/a.jpg', server + '/b.jpg'],
+    })
+    with im.create_session(retries=0) as session:
+        found = {position: (nip, path) for position, nip, path in im.iter_downloads(df, 2, session)}
+    assert found[0] == (111111, im.BASE_FOLDER / '111111.jpg')
+    assert (tmp_path / found[0][1]).read_bytes() == PHOTO
+    assert found[1] == (222222, None)
+    assert sorted(p.name for p in (tmp_path / im.BASE_FOLDER).iterdir()) == ['111111.jpg']
+
+
+def test_iter_downloads_without_url(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    df = pd.DataFrame({'NIP Unizar': [111111, 222222], 'Fotografia': [None, '']})
+    assert sorted(im.iter_downloads(df, 2)) == [(0, 111111, None), (1, 222222, None)]
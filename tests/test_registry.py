@@ -0,0 +1,37 @@
+"""
+First start of the registry from the legacy workbook.
+
+    python -m pytest tests
+"""
+import pandas as pd
+import pytest
+
+from registration.registry import StudentRegistry
+
+
+def test_legacy_import_with_missing_dates(tmp_path):
+    workbook = tmp_path / 'database.xlsx'
+    pd.DataFrame({
+        'NIP Unizar': [100000, 100001],
+        'Nombre': ['Ana', None],
+        'Fecha de Nacimiento': [pd.Timestamp('2000-02-01'), pd.NaT],
+    }).to_excel(workbook, index=False)
+    with StudentRegistry(tmp_path / 'registry.sqlite', legacy_excel=workbook) as registry:
+        assert len(registry) == 2
+        assert registry.get(100001)['Fecha de Nacimiento'] is None
+
+
+def test_failed_legacy_import_is_retried(tmp_path, monkeypatch):
+    workbook = tmp_path / 'database.xlsx'
+    pd.DataFrame({'NIP Unizar': [100000]}).to_excel(workbook, index=False)
+
+    def failing_import(self, path):
+        raise ValueError('unreadable workbook')
+    with monkeypatch.context() as m:
+        m.setattr(StudentRegistry, 'import_excel', failing_import)
+        with pytest.raises(ValueError):
+            StudentRegistry(tmp_path / 'registry.sqlite', legacy_excel=workbook)
+    assert list(tmp_path.glob('registry.sqlite*')) == []
+
+    with StudentRegistry(tmp_path / 'registry.sqlite', legacy_excel=workbook) as registry:
+        assert len(registry) == 1
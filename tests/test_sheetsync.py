@@ -0,0 +1,202 @@
+"""
+Incremental sheet reads against a local stand-in for the Sheets API.
+
+    python -m pytest tests
+"""
+import re
+import sqlite3
+import time
+
+import pandas as pd
+import pytest
+
+from registration import watcher
+from registration.registry import StudentRegistry
+from registration.sheetsync import FULL_SYNC_INTERVAL, SyncCursor, fetch_rows, header_fingerprint
+
+HEADER = ['Nombre', 'Apellidos', 'NIP Unizar', 'Email', 'Teléfono', 'Fecha de Nacimiento',
+          'Tratamiento de Datos', 'Fotografia']
+
+
+def response(nip:int) -> list[str]:
+    return ['Ana', 'Pérez', str(nip), f'{nip}@unizar.es', '612345678', '01/02/2000', 'Acepto',
+            f'https://drive.google.com/{nip}.jpg']
+
+
+class FakeSheets:
+    """Answers spreadsheets().values().get(range='A{n}:H') from a list of rows, like the API does."""
+
+    def __init__(self, rows:list[list[str]]):
+        self.rows = rows
+        self.ranges = []
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, range):
+        self.ranges.append(range)
+        first, last = re.fullmatch(r'A(\d+):H(\d*)', range).groups()
+        rows = self.rows[int(first) - 1:int(last) if last else None]
+        return self._Request({'values': rows} if rows else {})
+
+    class _Request:
+        def __init__(self, result):
+            self.result = result
+
+        def execute(self):
+            return self.result
+
+
+@pytest.fixture
+def sheet():
+    return FakeSheets([HEADER] + [response(100000 + i) for i in range(5)])
+
+
+def synced_cursor(next_row:int, last_full_sync:float | None = None) -> SyncCursor:
+    return SyncCursor(next_row=next_row, header_hash=header_fingerprint(HEADER),
+                      last_full_sync=time.time() if last_full_sync is None else last_full_sync)
+
+
+def test_reads_from_cursor(sheet):
+    df, cursor, full = fetch_rows(sheet, 'id', synced_cursor(4))
+    assert sheet.ranges == ['A1:H1', 'A4:H']
+    assert not full
+    assert df['NIP Unizar'].to_list() == ['100002', '100003', '100004']
+    assert cursor.next_row == 7
+
+
+def test_nothing_new(sheet):
+    df, cursor, full = fetch_rows(sheet, 'id', synced_cursor(7))
+    assert sheet.ranges[-1] == 'A7:H'
+    assert df.empty and not full
+    assert cursor.next_row == 7
+
+
+def test_pads_short_rows(sheet):
+    sheet.rows.append(response(100005)[:6])  # the API drops trailing empty cells
+    df, _, _ = fetch_rows(sheet, 'id', synced_cursor(7))
+    assert df.columns.to_list() == HEADER
+    assert df.iloc[0]['Fotografia'] is None
+
+
+def test_header_change_forces_full_read(sheet):
+    sheet.rows[0] = HEADER + ['Curso']
+    df, cursor, full = fetch_rows(sheet, 'id', synced_cursor(7))
+    assert sheet.ranges[-1] == 'A2:H'
+    assert full
+    assert len(df) == 5
+    assert cursor.header_hash == header_fingerprint(HEADER + ['Curso'])
+    assert cursor.rows_hash
+
+
+def test_full_read_every_interval(sheet):
+    now = time.time()
+    _, cursor, full = fetch_rows(sheet, 'id', synced_cursor(7, now - FULL_SYNC_INTERVAL + 3600))
+    assert sheet.ranges[-1] == 'A7:H' and not full
+
+    _, cursor, full = fetch_rows(sheet, 'id', synced_cursor(7, now - FULL_SYNC_INTERVAL - 3600))
+    assert sheet.ranges[-1] == 'A2:H' and full
+    assert cursor.last_full_sync >= now
+    assert cursor.next_row == 7
+
+
+def test_cursor_kept_when_registry_write_fails(sheet, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Photos are not what is under test here
+    monkeypatch.setattr(watcher, 'normalize_image', lambda df, pipeline: df.assign(Fotografia='photo.png'))
+    cursor_file = tmp_path / 'cursor.json'
+    synced_cursor(4, 0).save(cursor_file)
+    registry = StudentRegistry(tmp_path / 'registry.sqlite', legacy_excel=None)
+    upsert = registry.upsert
+
+    def failing_upsert(df):
+        if len(df):
+            raise sqlite3.OperationalError('disk I/O error')
+    registry.upsert = failing_upsert
+    with pytest.raises(sqlite3.OperationalError):
+        watcher.sheets_watcher(sheet, 'id', registry, cursor_file, pipeline=object())
+    assert SyncCursor.load(cursor_file) == synced_cursor(4, 0)
+
+    registry.upsert = upsert
+    assert watcher.sheets_watcher(sheet, 'id', registry, cursor_file, pipeline=object())
+    assert SyncCursor.load(cursor_file).next_row == 7
+    assert len(registry) == 5
+    registry.close()
+
+
+def test_invalid_responses_reported_once(sheet, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(watcher, 'normalize_image', lambda df, pipeline: df.assign(Fotografia='photo.png'))
+    sheet.rows.append(response(999999)[:3] + ['not an email'] + response(999999)[4:])
+    registry = StudentRegistry(tmp_path / 'registry.sqlite', legacy_excel=None)
+    cursor_file = tmp_path / 'cursor.json'
+    assert watcher.sheets_watcher(sheet, 'id', registry, cursor_file, pipeline=object())
+    assert pd.read_excel('nulls.xlsx')['NIP Unizar'].to_list() == [999999]
+
+    # The next full read still sees the invalid row, but it was already reported
+    sheet.rows.append(response(100005))
+    assert watcher.sheets_watcher(sheet, 'id', registry, cursor_file, full=True, pipeline=object())
+    assert pd.read_excel('nulls.xlsx').empty
+    assert len(registry) == 6
+    registry.close()
+
+
+def test_photo_duplicates_reported(sheet, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def normalize(df, pipeline):
+        df = df.assign(Fotografia='photo.png')
+        df.attrs['photo_duplicates'] = {100001: [(100000, 3)]}
+        return df
+    monkeypatch.setattr(watcher, 'normalize_image', normalize)
+    registry = StudentRegistry(tmp_path / 'registry.sqlite', legacy_excel=None)
+    assert watcher.sheets_watcher(sheet, 'id', registry, tmp_path / 'cursor.json', pipeline=object())
+    duplicates = pd.read_excel('nulls.xlsx', sheet_name='Duplicados')
+    assert duplicates.values.tolist() == [[100001, 100000, 3]]
+    registry.close()
+
+
+def test_failed_rows_retried_on_unchanged_sheet(sheet, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    broken = {100002}
+
+    def normalize(df, pipeline):
+        return df.assign(Fotografia=[None if nip in broken else 'photo.png' for nip in df['NIP Unizar']])
+    monkeypatch.setattr(watcher, 'normalize_image', normalize)
+    registry = StudentRegistry(tmp_path / 'registry.sqlite', legacy_excel=None)
+    cursor_file = tmp_path / 'cursor.json'
+    assert watcher.sheets_watcher(sheet, 'id', registry, cursor_file, pipeline=object())
+    assert len(registry) == 4 and SyncCursor.load(cursor_file).pending
+
+    # The sheet is the same, but the failed row is still tried again
+    broken.clear()
+    assert watcher.sheets_watcher(sheet, 'id', registry, cursor_file, full=True, pipeline=object())
+    assert len(registry) == 5 and not SyncCursor.load(cursor_file).pending
+    assert not watcher.sheets_watcher(sheet, 'id', registry, cursor_file, full=True, pipeline=object())
+    registry.close()
+
+
+def test_only_printed_edits_make_cards_stale(sheet, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(watcher, 'normalize_image', lambda df, pipeline: df.assign(Fotografia='photo.png'))
+    registry = StudentRegistry(tmp_path / 'registry.sqlite', legacy_excel=None)
+    cursor_file = tmp_path / 'cursor.json'
+    assert watcher.sheets_watcher(sheet, 'id', registry, cursor_file, pipeline=object())
+
+    # A new form question alone doesn't make any response 'changed'
+    sheet.rows[0] = HEADER + ['Curso']
+    sheet.rows[1:] = [row + ['1º'] for row in sheet.rows[1:]]
+    assert watcher.sheets_watcher(sheet, 'id', registry, cursor_file, full=True, pipeline=object())
+    assert registry.to_dataframe('card_stale = 1').empty
+
+    sheet.rows[1][4] = '699999999'  # phone of 100000
+    sheet.rows[2][0] = 'Eva'  # name of 100001
+    sheet.rows[3][7] = 'https://drive.google.com/new.jpg'  # photo of 100002
+    assert watcher.sheets_watcher(sheet, 'id', registry, cursor_file, full=True, pipeline=object())
+    stale = registry.to_dataframe('card_stale = 1')['NIP Unizar'].to_list()
+    assert stale == [100001, 100002]
+    assert registry.get(100000)['Teléfono'] == '699999999'
+    registry.close()
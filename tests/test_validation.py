@@ -0,0 +1,18 @@
+"""
+Form response validation.
+
+    python -m pytest tests
+"""
+import pandas as pd
+
+from registration.validation import REASON_COLUMN, validate
+
+
+def test_consent_wording():
+    answers = ['Acepto', 'He leído y acepto la política de privacidad', 'Sí', 'x',
+               'No acepto', 'No', None]
+    df = pd.DataFrame({'NIP Unizar': [str(100000 + i) for i in range(len(answers))],
+                       'Tratamiento de Datos': answers})
+    valid, rejected = validate(df)
+    assert valid['NIP Unizar'].to_list() == [100000, 100001, 100002, 100003]
+    assert set(rejected[REASON_COLUMN]) == {'Data processing consent not given'}